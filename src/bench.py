@@ -0,0 +1,419 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import time
+
+from helpers.server import *
+from chat_select import FRAME_HEADER, ChatServer, frame_bytes
+from forking_mixin import PreForkServer, Server, ServerHandler
+from threading_mixin import RequestHandler, ThreadedServer, ThreadPoolServer
+
+HOST = "127.0.0.1"
+
+
+# Servers under test, started in a child process with a silenced stdout
+def _serve_tcp(port):
+    tcp_echo_server(HOST, port)
+
+
+def _serve_tcp_async(port):
+    tcp_echo_server_async(HOST, port)
+
+
+def _serve_tcp_session(port):
+    tcp_echo_server_async(HOST, port, session=True)
+
+
+def _serve_shm(port):
+    shm_echo_server(HOST, port)
+
+
+def _serve_udp(port):
+    udp_echo_server(HOST, port)
+
+
+def _serve_udp_fast(port):
+    udp_echo_server_fast(HOST, port, receivers=os.cpu_count() or 1, processes=True)
+
+
+def _serve_threaded(port):
+    ThreadedServer((HOST, port), RequestHandler).serve_forever()
+
+
+def _serve_threadpool(port):
+    ThreadPoolServer((HOST, port), RequestHandler).serve_forever()
+
+
+def _serve_forking(port):
+    Server((HOST, port), ServerHandler).serve_forever()
+
+
+def _serve_prefork(port):
+    PreForkServer((HOST, port), ServerHandler).serve_forever()
+
+
+def _serve_chat(port):
+    ChatServer(port).run()
+
+
+# Target -> (server, client protocol, transport)
+TARGETS = {
+    "tcp": (_serve_tcp, "oneshot", "tcp"),
+    "tcp-async": (_serve_tcp_async, "oneshot", "tcp"),
+    "tcp-session": (_serve_tcp_session, "session", "tcp"),
+    "shm": (_serve_shm, "shm", "shm"),
+    "udp": (_serve_udp, "datagram", "udp"),
+    "udp-fast": (_serve_udp_fast, "datagram", "udp"),
+    "threaded": (_serve_threaded, "oneshot", "tcp"),
+    "threadpool": (_serve_threadpool, "oneshot", "tcp"),
+    "forking": (_serve_forking, "oneshot", "tcp"),
+    "prefork": (_serve_prefork, "oneshot", "tcp"),
+    "chat": (_serve_chat, "chat", "tcp"),
+}
+
+
+def _run_server(serve, port) -> None:
+    sys.stdout = open(os.devnull, "w")
+    configure_logging("off")  # Measure the server, not its packet log
+    serve(port)
+
+
+def _scan_shm(ip, port) -> bool:
+    return detect_protocols(shm_address(ip, port), port)[0]
+
+
+def start_server(target: str):
+    """Start a target server on a free loopback port and wait until it answers."""
+    serve, _, transport = TARGETS[target]
+    protocol = "udp" if transport == "udp" else "tcp"
+    port = find_available_port(HOST, 20000, protocol)
+    ctx = multiprocessing.get_context("fork")
+    process = ctx.Process(target=_run_server, args=(serve, port), daemon=True)
+    process.start()
+    PORT_ALLOCATOR.release(port, protocol)
+    scan = {"tcp": scan_tcp_port, "udp": scan_udp_port, "shm": _scan_shm}[transport]
+    deadline = time.monotonic() + 10
+    while not scan(HOST, port):
+        if time.monotonic() > deadline or not process.is_alive():
+            process.terminate()
+            raise RuntimeError(f"{target} server did not start on port {port}")
+        time.sleep(0.05)
+    return process, port
+
+
+class OneShot:
+    """A fresh connection per request, read until the server closes it."""
+
+    def __init__(self, port: int, payload: bytes) -> None:
+        self.port = port
+        self.payload = payload
+
+    async def open(self) -> None:
+        pass
+
+    async def request(self) -> None:
+        reader, writer = await asyncio.open_connection(HOST, self.port)
+        try:
+            writer.write(self.payload)
+            await writer.drain()
+            if not await reader.read():
+                raise ConnectionError("Empty reply")
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        pass
+
+
+class Session(OneShot):
+    """One persistent connection, each request waits for its exact echo."""
+
+    async def open(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(HOST, self.port)
+
+    async def request(self) -> None:
+        self.writer.write(self.payload)
+        await self.writer.drain()
+        await self.reader.readexactly(len(self.payload))
+
+    async def close(self) -> None:
+        self.writer.close()
+
+
+class Datagram(OneShot):
+    """One connected UDP socket, each request waits for its datagram back."""
+
+    async def open(self) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.connect((HOST, self.port))
+
+    async def request(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(self.sock, self.payload)
+        await loop.sock_recv(self.sock, 65536)
+
+    async def close(self) -> None:
+        self.sock.close()
+
+
+class SharedMemory(OneShot):
+    """One shared memory channel. Requests wait for their reply without
+    yielding to the event loop, so use --connections 1 to measure latency."""
+
+    async def open(self) -> None:
+        self.channel = ShmChannel.connect(HOST, self.port)
+
+    async def request(self) -> None:
+        self.channel.request(self.payload)
+
+    async def close(self) -> None:
+        self.channel.close()
+
+
+class ChatRoom:
+    """Chat clients sharing the lobby, a request completes when any other
+    client (there is always an extra observer) receives the message."""
+
+    def __init__(self, port: int, size: int) -> None:
+        self.port = port
+        self.size = size
+        self.pending = {}  # Message tag -> future
+        self.readers = []
+
+    async def join(self, name: str):
+        reader, writer = await asyncio.open_connection(HOST, self.port)
+        writer.write(frame_bytes(f"NAME: {name}"))
+        await self.read_frame(reader)  # CLIENT: reply
+        self.readers.append(asyncio.create_task(self.watch(reader)))
+        return writer
+
+    @staticmethod
+    async def read_frame(reader) -> str:
+        _, _, _, size = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        return (await reader.readexactly(size)).decode("utf-8", errors="replace")
+
+    async def watch(self, reader) -> None:
+        while True:
+            msg = await self.read_frame(reader)
+            tag = msg.rpartition(">> ")[2].split(" ", 1)[0]
+            future = self.pending.pop(tag, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def client(self, index: int) -> "ChatSender":
+        return ChatSender(self, index)
+
+    async def close(self) -> None:
+        for task in self.readers:
+            task.cancel()
+
+
+class ChatSender:
+    def __init__(self, room: ChatRoom, index: int) -> None:
+        self.room = room
+        self.index = index
+        self.seq = 0
+
+    async def open(self) -> None:
+        self.writer = await self.room.join(f"bench{self.index}")
+
+    async def request(self) -> None:
+        self.seq += 1
+        tag = f"{self.index}:{self.seq}"
+        future = asyncio.get_running_loop().create_future()
+        self.room.pending[tag] = future
+        text = f"{tag} ".ljust(self.room.size, "x")
+        self.writer.write(frame_bytes(text))
+        await self.writer.drain()
+        await future
+
+    async def close(self) -> None:
+        self.writer.close()
+
+
+async def _worker(client, deadline, interval, start, timeout, histogram, stats):
+    await client.open()
+    intended = start
+    try:
+        while True:
+            if interval:
+                # Open loop: latency counts from the scheduled send time so a
+                # stalled server cannot hide queueing delay (coordinated omission)
+                now = time.perf_counter()
+                if intended > now:
+                    await asyncio.sleep(intended - now)
+                began = intended
+                intended += interval
+            else:
+                began = time.perf_counter()
+            if began >= deadline:
+                break
+            try:
+                await asyncio.wait_for(client.request(), timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                stats["errors"] += 1
+                continue
+            histogram.record(int((time.perf_counter() - began) * 1e9))
+    finally:
+        await client.close()
+
+
+async def run_load(target, port, connections, size, rate, duration, timeout):
+    """Drive one target, returning the merged histogram, errors and elapsed time."""
+    protocol = TARGETS[target][1]
+    payload = b"x" * size
+    room = None
+    if protocol == "chat":
+        room = ChatRoom(port, size)
+        observer = await room.join("observer")
+        clients = [room.client(i) for i in range(connections)]
+    else:
+        kind = {
+            "oneshot": OneShot,
+            "session": Session,
+            "datagram": Datagram,
+            "shm": SharedMemory,
+        }[protocol]
+        clients = [kind(port, payload) for _ in range(connections)]
+
+    interval = connections / rate if rate else 0
+    histograms = [Histogram() for _ in clients]
+    stats = {"errors": 0}
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(
+        *(
+            _worker(
+                c,
+                deadline,
+                interval,
+                start + i * interval / connections,
+                timeout,
+                h,
+                stats,
+            )
+            for i, (c, h) in enumerate(zip(clients, histograms))
+        )
+    )
+    elapsed = time.perf_counter() - start
+    if room is not None:
+        observer.close()
+        await room.close()
+    histogram = Histogram()
+    for h in histograms:
+        histogram.merge(h)
+    return histogram, stats["errors"], elapsed
+
+
+def bench(target, connections=8, size=64, rate=None, duration=5.0, timeout=2.0) -> dict:
+    """Benchmark one target server on loopback and return its results."""
+    process, port = start_server(target)
+    try:
+        histogram, errors, elapsed = asyncio.run(
+            run_load(target, port, connections, size, rate, duration, timeout)
+        )
+    finally:
+        process.terminate()
+        process.join()
+    return {
+        "target": target,
+        "mode": "open" if rate else "closed",
+        "connections": connections,
+        "size": size,
+        "rate": rate,
+        "duration": round(elapsed, 3),
+        "requests": histogram.count,
+        "errors": errors,
+        "throughput_rps": round(histogram.count / elapsed, 1),
+        "latency_us": histogram.summary(),
+    }
+
+
+def compare(results: list, baseline: list) -> None:
+    """Print throughput and p99 changes against a previous run."""
+    previous = {r["target"]: r for r in baseline}
+    for result in results:
+        old = previous.get(result["target"])
+        if old is None:
+            continue
+        for label, new_value, old_value in (
+            ("throughput", result["throughput_rps"], old["throughput_rps"]),
+            ("p99", result["latency_us"]["p99"], old["latency_us"]["p99"]),
+        ):
+            change = (new_value - old_value) / old_value * 100 if old_value else 0
+            print(
+                f"{result['target']:>12} {label:>10}: {old_value} -> {new_value} ({change:+.1f}%)"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Loopback benchmark for the echo and chat servers"
+    )
+    parser.add_argument(
+        "--target",
+        action="append",
+        choices=[*TARGETS, "all"],
+        help="Server to benchmark, may be repeated (default: all).",
+    )
+    parser.add_argument(
+        "--connections", type=int, default=8, help="Concurrent clients."
+    )
+    parser.add_argument("--size", type=int, default=64, help="Message size in bytes.")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Total requests per second for an open-loop run (default: closed loop).",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=5.0, help="Seconds per target."
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=2.0, help="Per-request timeout."
+    )
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", help="Previous JSON results to compare with.")
+    args = parser.parse_args()
+
+    targets = args.target or ["all"]
+    if "all" in targets:
+        targets = list(TARGETS)
+
+    results = []
+    for target in targets:
+        result = bench(
+            target, args.connections, args.size, args.rate, args.duration, args.timeout
+        )
+        latency = result["latency_us"]
+        print(
+            f"{target:>12}: {result['throughput_rps']:>10} req/s  "
+            f"p50 {latency['p50']}us  p90 {latency['p90']}us  "
+            f"p99 {latency['p99']}us  p999 {latency['p999']}us  "
+            f"errors {result['errors']}"
+        )
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "host": platform.node(),
+                    "results": results,
+                },
+                out,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous)["results"])
+
+
+if __name__ == "__main__":
+    main()
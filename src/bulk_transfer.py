@@ -0,0 +1,97 @@
+import argparse
+import threading
+import time
+
+from helpers.server import *
+
+HOST = "127.0.0.1"
+SIZE_UNITS = {"K": 2**10, "M": 2**20, "G": 2**30}
+
+
+def parse_size(text: str) -> int:
+    """Parse a byte count such as 4096, 512K, 64M or 2G."""
+    unit = SIZE_UNITS.get(text[-1:].upper())
+    return int(float(text[:-1]) * unit) if unit else int(text)
+
+
+def run_clients(ip, port, streams, **kwargs) -> None:
+    """Run parallel bulk clients and report their combined throughput."""
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(tcp_bulk_client(ip, port, **kwargs))
+        )
+        for _ in range(streams)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if streams > 1:
+        total = sum(result["sent"] for result in results)
+        print(f"All {streams} streams: {format_throughput(total, elapsed)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk transfer client and server")
+    parser.add_argument("role", choices=("server", "client"))
+    parser.add_argument("--host", default=HOST, help="Address to bind or connect to.")
+    parser.add_argument("--port", type=int, required=True, help="Port number.")
+    parser.add_argument(
+        "--sink",
+        choices=BULK_SINKS,
+        default="discard",
+        help="Server only: drop payloads or store them in memory-mapped files.",
+    )
+    parser.add_argument(
+        "--output", default=None, help="Server only: directory for --sink mmap."
+    )
+    parser.add_argument(
+        "--max-size",
+        type=parse_size,
+        default=BULK_MAX_SIZE,
+        help="Server only: largest payload to accept, e.g. 8G.",
+    )
+    parser.add_argument(
+        "--file", default=None, help="Client only: send this file with sendfile."
+    )
+    parser.add_argument(
+        "--size",
+        type=parse_size,
+        default=parse_size("1G"),
+        help="Client only: generated bytes to send when no file is given.",
+    )
+    parser.add_argument(
+        "--echo",
+        action="store_true",
+        help="Client only: have the server send the payload back.",
+    )
+    parser.add_argument(
+        "--streams", type=int, default=1, help="Client only: parallel connections."
+    )
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    apply_metrics_arguments(args)
+
+    if args.role == "server":
+        try:
+            tcp_bulk_server(
+                args.host,
+                args.port,
+                sink=args.sink,
+                output=args.output,
+                max_size=args.max_size,
+            )
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_clients(
+            args.host,
+            args.port,
+            args.streams,
+            path=args.file,
+            size=args.size,
+            echo=args.echo,
+        )
@@ -1,170 +1,1256 @@
 import select
+import selectors
 import socket
 import sys
 import signal
 import pickle
 import struct
 import argparse
+import io
+import os
+import re
+import multiprocessing
+import threading
+import time
+from collections import Counter, deque
+from itertools import islice
+
+from helpers.history import *
+from helpers.lifecycle import *
+from helpers.metrics import *
+from helpers.ratelimit import *
+from helpers.timers import *
+from helpers.transport import *
 
 SERVER_HOST = "localhost"
 CHAT_SERVER_NAME = "server"
 
 
-def send(channel: socket.socket, *args: str) -> None:
-    buffer_data = pickle.dumps(args)
-    value = socket.htonl(len(buffer_data))
-    size = struct.pack("L", value)
-    channel.send(size)
-    channel.send(buffer_data)
+# Wire format: an 8 byte header (version, flags, reserved, body length) in
+# network byte order, followed by the UTF-8 body. Fields are NUL separated.
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!BBHI")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Flag of an empty keepalive frame: the server sends one to a quiet client,
+# which sends it straight back. Heartbeats are never shown to users.
+FRAME_HEARTBEAT = 0x01
+HEARTBEAT_FRAME = FRAME_HEADER.pack(FRAME_VERSION, FRAME_HEARTBEAT, 0, 0)
+
+# Most buffers a single vectored write may carry
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def encode_frame(*args: str) -> tuple[bytes, bytes]:
+    """Return the header and body buffers of a frame."""
+    body = "\0".join(args).encode("utf-8")
+    if len(body) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(body)} bytes exceeds {MAX_FRAME_SIZE}")
+    return FRAME_HEADER.pack(FRAME_VERSION, 0, 0, len(body)), body
+
+
+def send_buffers(channel: socket.socket, buffers: list) -> None:
+    """Write several buffers with as few syscalls as possible."""
+    if not hasattr(channel, "sendmsg"):  # Windows has no sendmsg
+        channel.sendall(b"".join(buffers))
+        return
+    views = [memoryview(b) for b in buffers if len(b)]
+    while views:
+        sent = channel.sendmsg(views)
+        # Drop fully written buffers and trim a partially written one
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def send(channel: socket.socket, *args: str, legacy: bool = False) -> None:
+    if legacy:
+        channel.sendall(_legacy_frame(args))
+        return
+    send_buffers(channel, list(encode_frame(*args)))
+
+
+def _recv_into(channel: socket.socket, view: memoryview) -> bool:
+    """Fill view from the channel, returning False if the peer hung up."""
+    received = 0
+    while received < len(view):
+        n = channel.recv_into(view[received:])
+        if not n:
+            return False
+        received += n
+    return True
+
+
+def _parse_header(header) -> tuple[int, bool, int]:
+    """Return the body size, legacy format and flags announced by a header."""
+    if header[0] == FRAME_VERSION:
+        _, flags, _, size = FRAME_HEADER.unpack(header)
+        legacy = False
+    elif _is_legacy_header(header):
+        size = int.from_bytes(header[:4], "big")
+        legacy = True
+        flags = 0
+    else:
+        raise ValueError(f"Unknown frame version {header[0]}")
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {size} bytes exceeds {MAX_FRAME_SIZE}")
+    return size, legacy, flags
+
+
+def _decode_body(body, legacy: bool) -> str:
+    if legacy:
+        return _legacy_loads(body)
+    return str(body, "utf-8", errors="replace").split("\0", 1)[0]
+
+
+def _decode_fields(body, legacy: bool) -> list[str]:
+    if legacy:
+        return [_legacy_loads(body)]
+    return str(body, "utf-8", errors="replace").split("\0")
+
+
+def receive_fields(channel: socket.socket) -> tuple[list[str] | None, bool]:
+    """Read one frame, returning all its fields and whether it was legacy.
+
+    A heartbeat is answered right away and returned as None, a closed or
+    broken stream as [""].
+    """
+    header = bytearray(FRAME_HEADER.size)
+    if not _recv_into(channel, memoryview(header)):
+        return [""], False
+    try:
+        size, legacy, flags = _parse_header(header)
+    except ValueError:
+        return [""], False  # Garbage on the wire, treat the peer as gone
+    if flags & FRAME_HEARTBEAT:
+        channel.sendall(HEARTBEAT_FRAME)
+        return None, False
+
+    body = bytearray(size)
+    if not _recv_into(channel, memoryview(body)):
+        return [""], legacy
+    return _decode_fields(body, legacy), legacy
+
+
+def receive_frame(channel: socket.socket) -> tuple[str | None, bool]:
+    """Read one frame, returning its first field and whether it was legacy.
+
+    A heartbeat is answered right away and returned as None.
+    """
+    fields, legacy = receive_fields(channel)
+    return (None if fields is None else fields[0]), legacy
+
+
+def receive(channel: socket.socket) -> str | None:
+    return receive_frame(channel)[0]
+
+
+def frame_bytes(*args: str, legacy: bool = False) -> bytes:
+    """Return a whole frame as one buffer, ready to be queued."""
+    if legacy:
+        return _legacy_frame(args)
+    return b"".join(encode_frame(*args))
+
+
+class FrameDecoder:
+    """Incrementally split the bytes of a non-blocking stream into frames."""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data) -> list[tuple[str, bool]]:
+        """Add received bytes and return every frame now complete.
+
+        Raises ValueError if the stream does not hold valid frames.
+        """
+        buf = self.buffer
+        buf += data
+        frames = []
+        offset = 0
+        with memoryview(buf) as view:
+            while len(buf) - offset >= FRAME_HEADER.size:
+                with view[offset : offset + FRAME_HEADER.size] as header:
+                    size, legacy, flags = _parse_header(header)
+                end = offset + FRAME_HEADER.size + size
+                if len(buf) < end:
+                    break
+                if not flags & FRAME_HEARTBEAT:  # Receiving it is all that counts
+                    with view[offset + FRAME_HEADER.size : end] as body:
+                        frames.append((_decode_body(body, legacy), legacy))
+                offset = end
+        del buf[:offset]
+        return frames
+
+
+# Compatibility shim for peers still speaking the old pickle wire format, a
+# native struct "L" holding htonl(length) (8 bytes on 64-bit Linux) and then
+# a pickled tuple of strings. Only plain tuples and strings are unpickled.
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name}")
+
+
+def _legacy_frame(args: tuple) -> bytes:
+    buffer_data = pickle.dumps(tuple(args))
+    return struct.pack("L", socket.htonl(len(buffer_data))) + buffer_data
+
+
+def _is_legacy_header(header: bytearray) -> bool:
+    # Legacy lengths are below 16 MiB, so the first byte and the upper half
+    # of the 8 byte native long are always zero
+    return struct.calcsize("L") == 8 and header[0] == 0 and not any(header[4:])
 
 
-def receive(channel: socket.socket) -> str:
-    size = struct.calcsize("L")
-    size_data = channel.recv(size)
+def _legacy_loads(body: bytearray) -> str:
     try:
-        size = socket.ntohl(struct.unpack("L", size_data)[0])
-    except struct.error:
+        args = _LegacyUnpickler(io.BytesIO(body)).load()
+    except (pickle.UnpicklingError, EOFError, ValueError):
         return ""
+    if not isinstance(args, tuple) or not args or not isinstance(args[0], str):
+        return ""
+    return args[0]
+
+
+# How long a worker keeps retrying a notice for a peer whose queue is full
+BUS_NOTICE_WAIT = 0.05
+
+
+class MessageBus:
+    """Relays broadcasts between ChatServer worker processes.
+
+    Every worker owns one non-blocking Unix datagram socket in the abstract
+    namespace and sends each broadcast to all of its peers, prefixed with
+    its history seq, if any, and its comma separated targets ("#room" or
+    "@name").
+    """
+
+    def __init__(self, name: str, worker: int, workers: int) -> None:
+        addresses = [f"\0{name}-{i}" for i in range(workers)]
+        self.peers = [a for i, a in enumerate(addresses) if i != worker]
+        self.dropped = 0  # Messages a peer could not take
+        self.buffer = bytearray(256 * 1024)  # Above the default datagram limit
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(addresses[worker])
+        self.sock.setblocking(False)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def publish(
+        self, targets: list[str], msg: str, seq: int | None = None, wait=0.0
+    ) -> None:
+        """Send a broadcast to every peer, dropping it where it does not fit.
+
+        A peer whose queue is full gets retries for up to `wait` seconds.
+        """
+        data = f"{seq or ''}\0{','.join(targets)}\0{msg}".encode("utf-8")
+        for peer in self.peers:
+            deadline = None
+            while True:
+                try:
+                    self.sock.sendto(data, peer)
+                except BlockingIOError:
+                    # Unconnected datagram sockets cannot poll a peer's queue
+                    deadline = deadline or time.monotonic() + wait
+                    if time.monotonic() < deadline:
+                        time.sleep(0.001)
+                        continue
+                    self.dropped += 1  # Peer is busy
+                except OSError:
+                    self.dropped += 1  # Peer is gone or the message is too big
+                break
+
+    def receive(self) -> list[tuple[list[str], str, int | None]]:
+        """Return the targets, text and seq of every message waiting on the bus.
+
+        Targets that are not a well-formed "#room" or "@name" are dropped,
+        and so are messages left without any.
+        """
+        messages = []
+        while True:
+            try:
+                n = self.sock.recv_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return messages
+            data = str(self.buffer[:n], "utf-8", errors="replace")
+            seq, _, data = data.partition("\0")
+            targets, _, msg = data.partition("\0")
+            targets = [
+                target
+                for target in targets.split(",")
+                if target[:1] in ("#", "@") and ROOM_NAME.fullmatch(target[1:])
+            ]
+            if targets:
+                seq = int(seq) if seq.isdigit() else None
+                messages.append((targets, msg, seq))
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+# Room every client joins on connect, plain messages go to the current room
+DEFAULT_ROOM = "lobby"
+ROOM_NAME = re.compile(r"[\w-]{1,32}")
+CHAT_COMMANDS = "/join <room>, /leave <room>, /msg <name> <text>, /history <seq>"
+HISTORY_BATCH = 256  # Missed messages queued per tick for a resyncing client
+READ_LATENCY_SAMPLE = 64  # Time one read in this many, every read while profiling
+
+# What to do when a client's outbound queue is full
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "disconnect", "backpressure")
+
+
+class Connection:
+    """Per-client state: the socket, its frame decoder and its outbound queue."""
 
-    buf = b""
-    while len(buf) < size:
-        buf += channel.recv(size - len(buf))
-    return pickle.loads(buf)[0]
+    def __init__(self, sock: socket.socket, address) -> None:
+        self.sock = sock
+        self.address = address
+        self.name = None  # Set once the NAME handshake arrives
+        self.rooms = set()  # Rooms joined
+        self.room = None  # Room plain messages are sent to
+        self.legacy = False  # Client still uses the pickle wire format
+        self.decoder = FrameDecoder()
+        self.outbox = deque()  # Encoded frames waiting to be written
+        self.offset = 0  # Bytes of outbox[0] already written
+        self.reading = True  # False while paused by backpressure
+        self.paused = set()  # Senders paused until this queue drains
+        self.events = 0  # Events currently registered with the selector
+        self.closed = False
+        self.last_read = 0.0  # When the client last sent anything
+        self.last_write = 0.0  # When a stalled outbox last made progress
+        self.read_timer = None  # Pending heartbeat or idle check
+        self.write_timer = None  # Pending check for a stalled outbox
+        self.limits = []  # (TokenBucket, "messages" or "bytes") charged per read
+        self.throttle_timer = None  # Set while reads wait for the buckets to refill
+        self.resync = None  # Last history seq replayed while catching up
+        self.resync_end = 0  # Newest seq to replay, later ones arrive live
+        self.resync_lost = 0  # Seqs this server never got, see MessageBus
 
 
 class ChatServer:
-    """An example chat server using select."""
+    """An example chat server using a selectors backend (epoll on Linux)."""
 
-    def __init__(self, port: int, backlog: int = 5) -> None:
+    def __init__(
+        self,
+        port: int,
+        backlog: int = 5,
+        selector: selectors.BaseSelector | None = None,
+        max_queue: int = 1024,
+        slow_policy: str = "drop_oldest",
+        reuse_port: bool = False,
+        bus: MessageBus | None = None,
+        shared_clients=None,
+        shared_seq=None,
+        stop_event: StopEvent | None = None,
+        host: str = SERVER_HOST,
+        heartbeat: float | None = 15.0,
+        idle_timeout: float | None = 45.0,
+        write_timeout: float | None = 30.0,
+        max_connections: int | None = None,
+        accept_rate: float | None = None,
+        client_rate: float | None = None,
+        client_byte_rate: float | None = None,
+        global_rate: float | None = None,
+        global_byte_rate: float | None = None,
+        history_bytes: int = HISTORY_MAX_BYTES,
+        history_log: str | None = None,
+    ) -> None:
+        if slow_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_policy}")
+        if reuse_port and is_unix_address(host):
+            raise ValueError("SO_REUSEPORT needs a TCP host, not a Unix socket")
+        self.host = host  # A hostname, or unix:/path and unix:@name for AF_UNIX
         self.clients = 0
-        self.clientmap = {}
-        self.outputs = []  # List of output sockets
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((SERVER_HOST, port))
-        print(f"Server listening to port: {port} ...")
+        self.bus = bus  # Set when running as one worker of a cluster
+        self.shared_clients = shared_clients  # Cluster-wide client count
+        self.clientmap = {}  # Client socket -> Connection
+        self.names = {}  # Client name -> its Connections, for direct messages
+        self.rooms = {}  # Room -> member Connections, for fan-out
+        self.outputs = set()  # Connections that completed the handshake
+        self.closing = []  # Connections to tear down at the end of the tick
+        self.dirty = set()  # Connections given new frames during this tick
+        self.max_queue = max_queue
+        self.slow_policy = slow_policy
+        # Deadlines in seconds, None disables them: heartbeat a client after
+        # `heartbeat` of silence, evict it after `idle_timeout`, and evict a
+        # client whose queued frames made no progress for `write_timeout`
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.write_timeout = write_timeout
+        self.now = time.monotonic()  # Sampled once per tick
+        self.timers = TimerWheel(now=self.now)
+        # Room broadcasts, numbered for clients catching up after a reconnect;
+        # history_bytes=0 turns it off, history_log also keeps it on disk
+        self.history = (
+            ChatHistory(history_bytes, history_log) if history_bytes else None
+        )
+        self.resyncing = set()  # Connections replaying missed messages
+        # Cluster-wide seq counter: a reconnecting client may land on any
+        # worker, so every worker must give a message the same seq
+        self.shared_seq = shared_seq
+        if shared_seq is not None and self.history:
+            with shared_seq.get_lock():
+                shared_seq.value = max(shared_seq.value, self.history.last_seq)
+        # Admission control, None means unlimited: at most `max_connections`
+        # clients (per worker in a cluster) and `accept_rate` new ones per
+        # second, anyone beyond that is turned away right after accept
+        self.max_connections = max_connections
+        self.accept_bucket = (
+            TokenBucket(accept_rate, now=self.now) if accept_rate else None
+        )
+        # Inbound messages and bytes per second, for each client and overall.
+        # A client that overdraws a bucket is not read from until it refills.
+        self.client_rates = [
+            (rate, unit)
+            for rate, unit in ((client_rate, "messages"), (client_byte_rate, "bytes"))
+            if rate
+        ]
+        self.limits = [
+            (TokenBucket(rate, now=self.now), unit)
+            for rate, unit in ((global_rate, "messages"), (global_byte_rate, "bytes"))
+            if rate
+        ]
+        # Per-policy counters: frames dropped, clients disconnected, senders paused
+        self.counters = Counter()
+        # Traffic counts, read by METRICS through collect() only when asked for
+        self.stats = Counter()
+        self.tracing = False  # PROFILER.enabled, sampled once per tick
+        self.reads = 0  # Read events handled, for sampling their latency
+        self.recv_buffer = bytearray(65536)  # Shared by every client read
+        # Any selectors implementation can be plugged in, DefaultSelector picks
+        # the best one available (epoll, kqueue, devpoll, poll, then select)
+        self.selector = selector or selectors.DefaultSelector()
+        self.server = server_socket(host)
+        if reuse_port:
+            # Let several workers bind the same port, the kernel balances accepts
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind(socket_address(host, port))
+        if is_unix_address(host):
+            print(f"Server listening on {host} ...")
+        else:
+            print(f"Server listening to port: {port} ...")
         self.server.listen(backlog)
-        # Catch keyboard interrupts
-        signal.signal(signal.SIGINT, self.sighandler)
+        self.server.setblocking(False)
+        # Set by shutdown() or Ctrl-C, wakes the selector so run() returns at once
+        self.stop_event = stop_event or StopEvent()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.sighandler)
+        METRICS.register(self.collect, server="chat")
+
+    def collect(self) -> dict:
+        """Return the traffic and slow consumer counts for the metrics registry."""
+        counts = dict(self.stats)  # Copied in one step, the loop may be running
+        for policy, count in dict(self.counters).items():
+            counts[f"slow_{policy}"] = count
+        if self.bus is not None:
+            counts["bus_dropped"] = self.bus.dropped
+        return counts
 
     def sighandler(self, signum, frame) -> None:
-        """Clean up client outputs."""
+        """Stop the server, run() closes the sockets once it leaves select."""
         print("Shutting down server...")
-        for output in self.outputs:
-            output.close()
-        self.server.close()
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        """Make run() return, from any thread."""
+        self.stop_event.set()
 
     def get_client_name(self, client: socket.socket) -> str:
         """Return the name of the client."""
-        info = self.clientmap[client]
-        host, name = info[0][0], info[1]
-        return f"@{name}@{host}"
+        conn = self.clientmap[client]
+        return f"@{conn.name}@{conn.address[0]}"
 
-    def run(self) -> None:
-        inputs = [self.server, sys.stdin]
-        self.outputs = []
-        running = True
-        while running:
-            try:
-                readable, writeable, exceptional = select.select(
-                    inputs, self.outputs, []
+    def update_events(self, conn: Connection) -> None:
+        """Register interest in reads unless paused, and in writes if queued."""
+        reading = conn.reading and conn.throttle_timer is None
+        events = selectors.EVENT_READ if reading else 0
+        if conn.outbox:
+            events |= selectors.EVENT_WRITE
+        if events == conn.events or conn.closed:
+            return
+        if not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        elif not events:
+            self.selector.unregister(conn.sock)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def enqueue(
+        self, conn: Connection, msg: str, sender: Connection | None = None
+    ) -> None:
+        """Queue a message for a client, applying the slow consumer policy."""
+        self.enqueue_frame(conn, frame_bytes(msg, legacy=conn.legacy), sender)
+
+    def enqueue_frame(
+        self, conn: Connection, frame: bytes, sender: Connection | None = None
+    ) -> None:
+        """Queue an already encoded frame, to be written at the end of the tick."""
+        if conn.closed:
+            return
+        if len(conn.outbox) >= self.max_queue:
+            if self.slow_policy == "disconnect":
+                self.counters["disconnected"] += 1
+                self.evict(conn)
+                return
+            elif self.slow_policy == "drop_oldest" or sender is None:
+                # Bus, join/leave and history traffic has no sender to pause,
+                # so backpressure falls back to dropping there too.
+                # Never drop a frame that is already partly on the wire
+                if not conn.offset:
+                    conn.outbox.popleft()
+                    self.counters["dropped"] += 1
+                elif len(conn.outbox) > 1:
+                    del conn.outbox[1]
+                    self.counters["dropped"] += 1
+            elif sender.reading:
+                # Stop reading from the sender until this queue drains. A
+                # paused sender adds no more than the rest of its last read
+                sender.reading = False
+                conn.paused.add(sender)
+                self.update_events(sender)
+                self.counters["paused"] += 1
+        conn.outbox.append(frame)
+        self.stats["messages_sent"] += 1
+        self.dirty.add(conn)
+
+    def publish(
+        self,
+        targets: list[str],
+        msg: str,
+        exclude: Connection | None = None,
+        notice: bool = False,
+    ) -> None:
+        """Queue a message for the targets on every worker of the cluster.
+
+        Notices (connects, hang-ups, joins and leaves) wait briefly for a
+        busy worker instead of being dropped right away.
+        """
+        if not targets:
+            return
+        wait = BUS_NOTICE_WAIT if notice else 0.0
+        if self.shared_seq is None or not self.recorded(targets):
+            self.fan_out(targets, msg, exclude)
+            if self.bus is not None:
+                self.bus.publish(targets, msg, wait=wait)
+            return
+        # Bus sends happen under the lock, so every smaller seq is already
+        # waiting on our bus: taking those first keeps the history in order.
+        # Workers waiting for the lock keep draining, or a worker retrying a
+        # notice for them would wait in vain
+        lock = self.shared_seq.get_lock()
+        while not lock.acquire(timeout=0.001):
+            self.drain_bus()
+        try:
+            self.drain_bus()
+            self.shared_seq.value += 1
+            seq = self.shared_seq.value
+            self.fan_out(targets, msg, exclude, seq)
+            self.bus.publish(targets, msg, seq, wait)
+        finally:
+            lock.release()
+
+    def drain_bus(self) -> None:
+        for targets, msg, seq in self.bus.receive():
+            self.fan_out(targets, msg, seq=seq)
+
+    def recorded(self, targets: list[str]) -> bool:
+        """Whether a message goes into the history: room messages only."""
+        return bool(self.history) and all(target[0] == "#" for target in targets)
+
+    def recipients(self, targets: list[str]):
+        """Return the local members of "#room" and "@name" targets."""
+        if len(targets) == 1:
+            target = targets[0]
+            index = self.rooms if target[0] == "#" else self.names
+            return index.get(target[1:], ())
+        members = set()
+        for target in targets:
+            index = self.rooms if target[0] == "#" else self.names
+            members.update(index.get(target[1:], ()))
+        return members
+
+    def fan_out(
+        self,
+        targets: list[str],
+        msg: str,
+        exclude: Connection | None = None,
+        seq: int | None = None,
+    ) -> None:
+        """Queue a message for the local members of the targets except `exclude`.
+
+        Costs O(recipients): members are looked up in the room and name
+        indexes. The frame is encoded once per wire format and the same
+        immutable bytes object is shared by every recipient's queue.
+        """
+        if self.recorded(targets):
+            # Room messages carry their seq as a second field, old clients
+            # only read the first one and legacy frames leave it out
+            seq = (str(self.history.append(targets, msg, seq)),)
+        else:
+            seq = ()
+        frames = {}
+        for output in tuple(self.recipients(targets)):
+            if output is not exclude:
+                frame = frames.get(output.legacy)
+                if frame is None:
+                    if self.tracing:
+                        start = time.perf_counter_ns()
+                    if output.legacy:
+                        frame = frame_bytes(msg, legacy=True)
+                    else:
+                        frame = frame_bytes(msg, *seq)
+                    frames[output.legacy] = frame
+                    if self.tracing:
+                        PROFILER.lap("chat", "encode", start)
+                self.enqueue_frame(output, frame, sender=exclude)
+
+    def flush(self, conn: Connection) -> None:
+        """Write queued frames, many per vectored write, until the socket would block."""
+        try:
+            while conn.outbox:
+                buffers = list(islice(conn.outbox, IOV_MAX))
+                buffers[0] = memoryview(buffers[0])[conn.offset :]
+                queued = sum(len(b) for b in buffers)
+                if hasattr(conn.sock, "sendmsg"):
+                    sent = conn.sock.sendmsg(buffers)
+                else:  # Windows has no sendmsg
+                    sent = conn.sock.send(b"".join(buffers))
+                self.advance(conn, sent)
+                if sent:
+                    conn.last_write = self.now
+                self.stats["bytes_sent"] += sent
+                if sent < queued:
+                    break  # Kernel buffer is full, wait for the next writable event
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.stats["errors"] += 1
+            self.evict(conn)
+            return
+        if conn.paused and len(conn.outbox) <= self.max_queue // 2:
+            self.resume(conn)
+        if conn.outbox and conn.write_timer is None and self.write_timeout is not None:
+            # The kernel buffer is full, the client has write_timeout to drain it
+            conn.last_write = self.now
+            conn.write_timer = self.timers.schedule(
+                self.now + self.write_timeout, self.check_writes, conn
+            )
+        self.update_events(conn)
+
+    def advance(self, conn: Connection, sent: int) -> None:
+        """Pop frames fully written by the last send and track the partial one."""
+        outbox = conn.outbox
+        while sent and outbox:
+            remaining = len(outbox[0]) - conn.offset
+            if sent < remaining:
+                conn.offset += sent
+                return
+            sent -= remaining
+            outbox.popleft()
+            conn.offset = 0
+
+    def resume(self, conn: Connection) -> None:
+        """Start reading again from senders paused on this connection."""
+        for sender in conn.paused:
+            if not sender.closed:
+                sender.reading = True
+                self.update_events(sender)
+        conn.paused.clear()
+
+    def count_client(self, delta: int) -> None:
+        """Track the number of clients, across all workers in cluster mode."""
+        if self.shared_clients is None:
+            self.clients += delta
+            return
+        with self.shared_clients.get_lock():
+            self.shared_clients.value += delta
+            self.clients = self.shared_clients.value
+
+    def accept(self) -> None:
+        """Accept a new client and register it with the selector."""
+        try:
+            client, address = self.server.accept()
+        except BlockingIOError:
+            return
+        if (
+            self.max_connections is not None
+            and len(self.clientmap) >= self.max_connections
+        ):
+            self.reject(client, "rejected_full", "Server full")
+            return
+        if self.accept_bucket and not self.accept_bucket.try_take(1, self.now):
+            self.reject(client, "rejected_rate", "Too many new connections")
+            return
+        credentials = peer_credentials(client)
+        if credentials is not None:
+            # Unix clients have no address, they are known by pid and uid
+            address = (describe_peer(address, credentials), None)
+        if should_log():
+            packet_log.info(
+                "Chat server: got connection %d from %s", client.fileno(), address
+            )
+        self.stats["connections"] += 1
+        METRICS.add("connections_active", 1, server="chat")
+        client.setblocking(False)
+        conn = Connection(client, address)
+        conn.last_read = self.now
+        conn.limits = [
+            (TokenBucket(rate, now=self.now), u) for rate, u in self.client_rates
+        ]
+        self.clientmap[client] = conn
+        self.update_events(conn)
+        self.watch_reads(conn)
+
+    def reject(self, client: socket.socket, counter: str, reason: str) -> None:
+        """Turn a client away before it costs any state, telling it why."""
+        self.stats[counter] += 1
+        if should_log():
+            packet_log.info("Chat server: rejected %d, %s", client.fileno(), reason)
+        try:
+            client.send(frame_bytes(f"REJECTED: {reason}, try again later"))
+        except OSError:
+            pass
+        client.close()
+
+    def throttle(self, conn: Connection, messages: int, size: int) -> None:
+        """Charge a read to the client's and the global buckets.
+
+        The read is charged in full, and a client that drove a bucket into
+        debt is not read from again until the debt is paid off. Its socket
+        buffer then fills up and TCP slows the sender down, so a flooder
+        cannot make everybody else wait for the fan-out of its messages.
+        """
+        wait = 0.0
+        for limits, counter in ((conn.limits, "client"), (self.limits, "global")):
+            for bucket, unit in limits:
+                delay = bucket.consume(
+                    messages if unit == "messages" else size, self.now
                 )
-            except select.error:
-                break
+                if delay > wait:
+                    wait, reason = delay, counter
+        if wait:
+            self.stats[f"throttled_{reason}"] += 1
+            conn.throttle_timer = self.timers.schedule(
+                self.now + wait, self.unthrottle, conn
+            )
+            self.update_events(conn)
+
+    def unthrottle(self, conn: Connection) -> None:
+        conn.throttle_timer = None
+        self.update_events(conn)
+
+    def watch_reads(self, conn: Connection) -> None:
+        """Schedule the next heartbeat or idle check for a client."""
+        deadlines = []
+        if self.idle_timeout is not None:
+            deadlines.append(conn.last_read + self.idle_timeout)
+        if self.heartbeat is not None:
+            # Every `heartbeat` seconds for as long as the client stays quiet
+            deadlines.append(max(conn.last_read, self.now) + self.heartbeat)
+        if deadlines:
+            conn.read_timer = self.timers.schedule(
+                min(deadlines), self.check_reads, conn
+            )
 
-            for sock in readable:
-                if sock == self.server:
-                    client, address = self.server.accept()
-                    print(
-                        f"Chat server: got connection {client.fileno()} from {address}"
+    def check_reads(self, conn: Connection) -> None:
+        """Heartbeat a quiet client, or evict it once it stayed quiet for too long.
+
+        Reads only refresh conn.last_read, the timer notices them when it
+        fires and is simply scheduled again for the new deadline.
+        """
+        conn.read_timer = None
+        if conn.closed:
+            return
+        quiet = self.now - conn.last_read
+        if self.idle_timeout is not None and quiet >= self.idle_timeout:
+            if should_log():
+                packet_log.info("Chat server: %d timed out", conn.sock.fileno())
+            self.stats["idle_timeouts"] += 1
+            self.evict(conn)
+            return
+        heartbeat = self.heartbeat is not None and quiet >= self.heartbeat
+        # Legacy clients cannot answer heartbeats, but still time out
+        if heartbeat and conn.name and not conn.legacy:
+            self.enqueue_frame(conn, HEARTBEAT_FRAME)
+            self.stats["heartbeats"] += 1
+        self.watch_reads(conn)
+
+    def check_writes(self, conn: Connection) -> None:
+        """Evict a client whose queued frames stopped draining."""
+        conn.write_timer = None
+        if conn.closed or not conn.outbox:
+            return
+        deadline = conn.last_write + self.write_timeout
+        if self.now < deadline:
+            conn.write_timer = self.timers.schedule(deadline, self.check_writes, conn)
+            return
+        if should_log():
+            packet_log.info("Chat server: %d stopped reading", conn.sock.fileno())
+        self.stats["write_timeouts"] += 1
+        self.evict(conn)
+
+    def greet(self, conn: Connection, hello: str, legacy: bool) -> None:
+        """Complete the NAME handshake and announce the new client."""
+        try:
+            conn.name = hello.split("NAME: ")[1]
+        except IndexError:
+            self.evict(conn)
+            return
+        if not ROOM_NAME.fullmatch(conn.name):
+            # Names end up in comma separated bus targets, keep them plain
+            try:
+                conn.sock.send(
+                    frame_bytes(
+                        "REJECTED: names are 1-32 letters, digits, _ or -",
+                        legacy=legacy,
                     )
-                    cname = receive(client).split("NAME: ")[1]
+                )
+            except OSError:
+                pass
+            conn.name = None
+            self.evict(conn)
+            return
+        conn.legacy = legacy
+        self.count_client(1)
+        # The current seq lets the client ask for what it misses from here on
+        seq = (str(self.history.last_seq),) if self.history and not legacy else ()
+        self.enqueue_frame(
+            conn, frame_bytes(f"CLIENT: {conn.address[0]}", *seq, legacy=legacy)
+        )
+
+        msg = f"\n(Connected: New client ({self.clients}) from {self.get_client_name(conn.sock)})"
+        self.publish([f"#{DEFAULT_ROOM}"], msg, notice=True)
+        self.outputs.add(conn)
+        self.names.setdefault(conn.name, set()).add(conn)
+        self.join(conn, DEFAULT_ROOM)
+
+    def join(self, conn: Connection, room: str) -> None:
+        self.rooms.setdefault(room, set()).add(conn)
+        conn.rooms.add(room)
+        conn.room = room
+
+    def leave(self, conn: Connection, room: str) -> None:
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(conn)
+            if not members:
+                del self.rooms[room]
+        conn.rooms.discard(room)
+        if conn.room == room:
+            conn.room = next(iter(conn.rooms), None)
+
+    def command(self, conn: Connection, line: str) -> None:
+        """Run a /join, /leave, /msg or /history command sent by a client."""
+        name = self.get_client_name(conn.sock)
+        verb, _, rest = line.partition(" ")
+        if verb in ("/join", "/leave") and ROOM_NAME.fullmatch(rest):
+            if verb == "/join":
+                self.join(conn, rest)
+                self.publish(
+                    [f"#{rest}"], f"\n(Joined #{rest}: {name})", conn, notice=True
+                )
+                self.enqueue(conn, f"\n(Now talking in #{rest})")
+            elif rest in conn.rooms:
+                self.leave(conn, rest)
+                self.publish([f"#{rest}"], f"\n(Left #{rest}: {name})", notice=True)
+                self.enqueue(conn, f"\n(Left #{rest})")
+        elif verb == "/msg" and " " in rest:
+            target, text = rest.split(" ", 1)
+            if not ROOM_NAME.fullmatch(target) or (
+                self.bus is None and target not in self.names
+            ):
+                self.enqueue(conn, f"\n(No such client: {target})")
+                return
+            self.publish([f"@{target}"], f"\n#[{name}]-> {text}", exclude=conn)
+        elif verb == "/history" and rest.isdigit():
+            self.start_resync(conn, int(rest))
+        else:
+            self.enqueue(conn, f"\n(Commands: {CHAT_COMMANDS})")
+
+    def start_resync(self, conn: Connection, seq: int) -> None:
+        """Replay the room messages a client missed after `seq`, in batches."""
+        if not self.history:
+            self.enqueue(conn, "\n(History is turned off on this server)")
+            return
+        if seq >= self.history.last_seq:
+            self.enqueue(conn, f"\n(Nothing missed since #{seq})")
+            return
+        if seq + 1 < self.history.first_seq:
+            first = self.history.first_seq
+            self.enqueue(conn, f"\n(Messages before #{first} are no longer kept)")
+            seq = first - 1
+        conn.resync = seq
+        conn.resync_end = self.history.last_seq
+        conn.resync_lost = 0
+        self.resyncing.add(conn)
+
+    def replay(self, conn: Connection) -> None:
+        """Queue the next batch of missed messages from the client's rooms."""
+        batch = max(1, min(HISTORY_BATCH, self.max_queue // 2))
+        entries = self.history.since(
+            conn.resync, min(batch, conn.resync_end - conn.resync)
+        )
+        for seq, targets, msg in entries:
+            if any(target[1:] in conn.rooms for target in targets):
+                fields = (msg,) if conn.legacy else (msg, str(seq))
+                self.enqueue_frame(conn, frame_bytes(*fields, legacy=conn.legacy))
+            # Seqs only skip ahead where a cluster worker dropped bus messages
+            conn.resync_lost += seq - conn.resync - 1
+            conn.resync = seq
+        if not entries or conn.resync >= conn.resync_end:
+            conn.resync_lost += conn.resync_end - conn.resync
+            lost = conn.resync_lost
+            note = f", {lost} lost between cluster workers" if lost else ""
+            self.enqueue(conn, f"\n(Caught up to #{conn.resync_end}{note})")
+            self.resyncing.discard(conn)
+            conn.resync = None
+
+    def evict(self, conn: Connection) -> None:
+        """Schedule a client to be dropped once the current tick is done."""
+        if not conn.closed:
+            conn.closed = True
+            self.closing.append(conn)
+
+    def disconnect(self, conn: Connection) -> None:
+        """Unregister a client, forget about it and tell the others."""
+        if conn.events:
+            self.selector.unregister(conn.sock)
+        self.timers.cancel(conn.read_timer)
+        self.timers.cancel(conn.write_timer)
+        self.timers.cancel(conn.throttle_timer)
+        self.resyncing.discard(conn)
+        self.resume(conn)
+        self.outputs.discard(conn)
+        self.clientmap.pop(conn.sock, None)
+        conn.sock.close()
+        METRICS.add("connections_active", -1, server="chat")
+        if conn.name is not None:
+            sessions = self.names.get(conn.name)
+            sessions.discard(conn)
+            if not sessions:
+                del self.names[conn.name]
+            rooms = [f"#{room}" for room in conn.rooms]
+            for room in tuple(conn.rooms):
+                self.leave(conn, room)
+            self.count_client(-1)
+            if rooms:  # A client may have left every room before hanging up
+                msg = f"\n(Now hung up: Client from @{conn.name}@{conn.address[0]})"
+                self.publish(rooms, msg, notice=True)
 
-                    self.clients += 1
-                    send(client, f"CLIENT: {address[0]}")
-                    inputs.append(client)
-                    self.clientmap[client] = (address, cname)
+    def handle(self, conn: Connection) -> None:
+        """Read from a client and relay each complete message to everybody else."""
+        if self.tracing:
+            start = time.perf_counter_ns()
+        try:
+            n = conn.sock.recv_into(self.recv_buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.stats["errors"] += 1
+            self.evict(conn)
+            return
+        if not n:
+            if should_log():
+                packet_log.info("Chat server: %d hung up", conn.sock.fileno())
+            self.evict(conn)
+            return
+        conn.last_read = self.now
+        self.stats["bytes_received"] += n
+        if self.tracing:
+            start = PROFILER.lap("chat", "recv", start)
+        try:
+            frames = conn.decoder.feed(memoryview(self.recv_buffer)[:n])
+        except ValueError:
+            self.stats["errors"] += 1
+            self.evict(conn)
+            return
+        self.stats["messages_received"] += len(frames)
+        if conn.limits or self.limits:
+            self.throttle(conn, len(frames), n)
+        if self.tracing:
+            start = PROFILER.lap("chat", "decode", start)
+        for data, legacy in frames:
+            if conn.closed:
+                break
+            if conn.name is None:
+                self.greet(conn, data, legacy)
+            elif data.startswith("/"):
+                self.command(conn, data)
+            elif data and conn.room is None:
+                self.enqueue(conn, f"\n(Join a room first: {CHAT_COMMANDS})")
+            elif data:
+                name = self.get_client_name(conn.sock)
+                if conn.room == DEFAULT_ROOM:
+                    msg = f"\n#[{name}]>> {data}"
+                else:
+                    msg = f"\n#{conn.room}[{name}]>> {data}"
+                self.publish([f"#{conn.room}"], msg, exclude=conn)
+        if self.tracing:
+            PROFILER.lap("chat", "dispatch", start)  # Includes "encode"
 
-                    msg = f"\n(Connected: New client ({self.clients}) from {self.get_client_name(client)})"
-                    for output in self.outputs:
-                        send(output, msg)
-                    self.outputs.append(client)
+    def run(self) -> None:
+        self.selector.register(self.server, selectors.EVENT_READ)
+        try:
+            self.selector.register(sys.stdin, selectors.EVENT_READ)
+        except (OSError, ValueError):
+            pass  # stdin is not pollable, e.g. redirected from a regular file
+        if self.bus is not None:
+            self.selector.register(self.bus, selectors.EVENT_READ)
+        self.selector.register(self.stop_event, selectors.EVENT_READ)
+        running = True
+        while running and not self.stop_event.is_set():
+            # Read once per tick, the profiler may be toggled from another thread
+            tracing = self.tracing = PROFILER.enabled
+            if tracing:
+                lap = time.perf_counter_ns()
+            try:
+                # Sleep until the next timer is due at the latest, or not at
+                # all while a resyncing client has room for another batch
+                if any(not conn.outbox for conn in self.resyncing):
+                    timeout = 0
+                else:
+                    timeout = self.timers.timeout(self.now)
+                events = self.selector.select(timeout)
+            except (OSError, ValueError):
+                break
+            self.now = time.monotonic()
+            if tracing:
+                PROFILER.lap("chat", "select", lap)
 
-                elif sock == sys.stdin:
+            for key, mask in events:
+                sock = key.fileobj
+                if sock is self.server:
+                    if tracing:
+                        lap = time.perf_counter_ns()
+                    self.accept()
+                    if tracing:
+                        PROFILER.lap("chat", "accept", lap)
+                elif sock is sys.stdin:
                     sys.stdin.readline()
                     running = False
+                elif sock is self.stop_event:
+                    running = False
+                elif sock is self.bus:
+                    if tracing:
+                        lap = time.perf_counter_ns()
+                    self.drain_bus()
+                    if tracing:
+                        PROFILER.lap("chat", "bus", lap)
                 else:
-                    try:
-                        data = receive(sock)
-                        if data:
-                            msg = f"\n#[{self.get_client_name(sock)}]>> {data}"
-                            for output in self.outputs:
-                                if output != sock:
-                                    send(output, msg)
+                    conn = key.data
+                    if mask & selectors.EVENT_READ and not conn.closed:
+                        self.reads += 1
+                        if tracing or not self.reads % READ_LATENCY_SAMPLE:
+                            start = time.perf_counter_ns()
+                            self.handle(conn)
+                            elapsed = time.perf_counter_ns() - start
+                            METRICS.observe(
+                                "latency", elapsed, server="chat", stage="read"
+                            )
                         else:
-                            print(f"Chat server: {sock.fileno()} hung up")
-                            self.clients -= 1
-                            sock.close()
-                            inputs.remove(sock)
-                            self.outputs.remove(sock)
-
-                            msg = f"\n(Now hung up: Client from {self.get_client_name(sock)})"
-                            for output in self.outputs:
-                                send(output, msg)
-                    except socket.error:
-                        inputs.remove(sock)
-                        self.outputs.remove(sock)
+                            self.handle(conn)
+                    if mask & selectors.EVENT_WRITE and not conn.closed:
+                        if tracing:
+                            lap = time.perf_counter_ns()
+                        self.flush(conn)
+                        if tracing:
+                            PROFILER.lap("chat", "write", lap)
+
+            # Heartbeats and timeouts due by now, queued or evicted below
+            if tracing:
+                lap = time.perf_counter_ns()
+            self.timers.advance(self.now)
+            if tracing:
+                PROFILER.lap("chat", "timers", lap)
+            # Tearing down can queue hang-up notices that evict more clients
+            if tracing and self.closing:
+                lap = time.perf_counter_ns()
+                while self.closing:
+                    self.disconnect(self.closing.pop())
+                PROFILER.lap("chat", "teardown", lap)
+            while self.closing:
+                self.disconnect(self.closing.pop())
+            # One batch of history per tick for every client keeping up with it
+            for conn in tuple(self.resyncing):
+                if len(conn.outbox) < HISTORY_BATCH:
+                    self.replay(conn)
+            # Everything queued this tick goes out in one write per client,
+            # only clients the kernel cannot keep up with wait for EVENT_WRITE
+            if not self.dirty:
+                continue
+            start = time.perf_counter_ns()
+            while self.dirty:
+                conn = self.dirty.pop()
+                if not conn.closed:
+                    self.flush(conn)
+                while self.closing:
+                    self.disconnect(self.closing.pop())
+            elapsed = time.perf_counter_ns() - start
+            METRICS.observe("latency", elapsed, server="chat", stage="flush")
+            if tracing:
+                PROFILER.record("chat", "flush", elapsed)
+        print(f"Slow consumers: {dict(self.counters)}")
+        METRICS.unregister(self.collect)
+        METRICS.add("connections_active", -len(self.clientmap), server="chat")
+        for conn in list(self.clientmap.values()):
+            conn.sock.close()
+        self.clientmap.clear()
+        if self.history:
+            self.history.close()
+        self.selector.close()
         self.server.close()
+        remove_unix_socket(self.host)
+
+
+def _cluster_worker(
+    port: int, worker: int, buses: list, shared_counters, stats_port, kwargs
+) -> None:
+    for i, bus in enumerate(buses):
+        if i != worker:
+            bus.close()  # Inherited from the parent, only our own end is used
+    if stats_port is not None:
+        start_stats_server(port=stats_port + worker)
+    if PROFILER.output:
+        PROFILER.output = f"{PROFILER.output}.{worker}"
+    if kwargs.get("history_log"):
+        # Every worker logs all room messages under the shared seqs
+        kwargs = {**kwargs, "history_log": f"{kwargs['history_log']}.{worker}"}
+    shared_clients, shared_seq = shared_counters
+    server = ChatServer(
+        port,
+        reuse_port=True,
+        bus=buses[worker],
+        shared_clients=shared_clients,
+        shared_seq=shared_seq,
+        **kwargs,
+    )
+    # terminate() from the parent stops the loop instead of killing it mid-tick
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    server.run()
+
+
+def run_cluster(
+    port: int, workers: int, stats_port: int | None = None, **kwargs
+) -> None:
+    """Run ChatServer worker processes sharing one port through SO_REUSEPORT.
+
+    Broadcasts, including connect and hang-up notices, travel between the
+    workers over a MessageBus. With `stats_port` set, worker i serves its
+    own metrics on stats_port + i. Room messages take their history seq
+    from a counter all workers share, so a client may resync on any of
+    them. Press Enter to stop the cluster.
+    """
+    ctx = multiprocessing.get_context("fork")
+    shared_counters = (ctx.Value("i", 0), ctx.Value("Q", 0))  # Clients, history seq
+    name = f"chat-{port}-{os.getpid()}"
+    buses = [MessageBus(name, i, workers) for i in range(workers)]
+    processes = [
+        ctx.Process(
+            target=_cluster_worker,
+            args=(port, i, buses, shared_counters, stats_port, kwargs),
+            daemon=True,
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for bus in buses:
+        bus.close()
+    print(f"Chat cluster: {workers} workers sharing port {port}")
+    try:
+        sys.stdin.readline()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
 
 class ChatClient:
     """A command line chat client using select."""
 
-    def __init__(self, name: str, port: int, host: str = SERVER_HOST) -> None:
+    def __init__(
+        self,
+        name: str,
+        port: int,
+        host: str = SERVER_HOST,
+        legacy: bool = False,
+        since: int | None = None,
+    ) -> None:
         self.name = name
+        self.legacy = legacy  # Talk the pickle wire format to an old server
+        self.last_seq = None  # Newest room message seen, to resync from later
         self.connected = False
         self.host = host
         self.port = port
         self.prompt = f"[{self.name}@{socket.gethostname().split('.')[0]}> "
 
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((host, self.port))
+            self.sock = connect_to(host, self.port)
             print(f"Now connected to chat server@ port {self.port}")
             self.connected = True
-            send(self.sock, f"NAME: {self.name}")
-            data = receive(self.sock)
+            send(self.sock, f"NAME: {self.name}", legacy=self.legacy)
+            fields, _ = receive_fields(self.sock)
+            data = fields[0] if fields else ""
+            if not data.startswith("CLIENT: "):
+                print(f"Chat server turned us away: {data or 'connection closed'}")
+                sys.exit(1)
+            self.track(fields)
             addr = data.split("CLIENT: ")[1]
             self.prompt = f"[{self.name}@{addr}]> "
+            if since is not None:
+                # Ask for the room messages missed since an earlier session
+                send(self.sock, f"/history {since}", legacy=self.legacy)
         except socket.error:
             print(f"Failed to connect to chat server @ port {self.port}")
             sys.exit(1)
 
+    def track(self, fields: list[str]) -> None:
+        """Remember the seq a server attaches to room messages."""
+        if len(fields) > 1 and fields[1].isdigit():
+            self.last_seq = max(int(fields[1]), self.last_seq or 0)
+
     def run(self) -> None:
         """Chat client main loop."""
+        prompt = True
         while self.connected:
             try:
-                sys.stdout.write(self.prompt)
-                sys.stdout.flush()
+                if prompt:
+                    sys.stdout.write(self.prompt)
+                    sys.stdout.flush()
+                prompt = True
                 readable, _, _ = select.select([0, self.sock], [], [])
                 for sock in readable:
                     if sock == 0:
                         data = sys.stdin.readline().strip()
                         if data:
-                            send(self.sock, data)
+                            send(self.sock, data, legacy=self.legacy)
                     elif sock == self.sock:
-                        data = receive(self.sock)
-                        if not data:
+                        fields, _ = receive_fields(self.sock)
+                        if fields is None:
+                            prompt = False  # A heartbeat, already answered
+                        elif not fields[0]:
                             print("Client shutting down.")
                             self.connected = False
                             break
                         else:
-                            sys.stdout.write(data + "\n")
+                            self.track(fields)
+                            sys.stdout.write(fields[0] + "\n")
                             sys.stdout.flush()
             except KeyboardInterrupt:
                 print("Client interrupted.")
                 self.sock.close()
                 break
+        if self.last_seq is not None:
+            seq = self.last_seq
+            print(f"Last message seen: #{seq}, catch up later with --since {seq}")
 
 
 if __name__ == "__main__":
@@ -173,11 +1259,144 @@ if __name__ == "__main__":
     parser.add_argument(
         "--port", type=int, required=True, help="Port number to connect to."
     )
+    parser.add_argument(
+        "--host",
+        default=SERVER_HOST,
+        help="Host to connect or bind to, or unix:/path and unix:@name.",
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Client only: use the old pickle wire format.",
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=1024,
+        help="Server only: frames queued per client before the slow policy applies.",
+    )
+    parser.add_argument(
+        "--slow-policy",
+        choices=SLOW_CONSUMER_POLICIES,
+        default="drop_oldest",
+        help="Server only: how to treat clients whose queue is full.",
+    )
+    parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=15.0,
+        help="Server only: seconds of client silence before a heartbeat, 0 for none.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=45.0,
+        help="Server only: seconds of client silence before eviction, 0 for never.",
+    )
+    parser.add_argument(
+        "--write-timeout",
+        type=float,
+        default=30.0,
+        help="Server only: seconds a client may stall its queue before eviction.",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        help="Server only: clients at once (per worker), others are turned away.",
+    )
+    parser.add_argument(
+        "--accept-rate",
+        type=float,
+        help="Server only: new connections per second, others are turned away.",
+    )
+    parser.add_argument(
+        "--client-rate",
+        type=float,
+        help="Server only: messages per second read from each client.",
+    )
+    parser.add_argument(
+        "--client-byte-rate",
+        type=float,
+        help="Server only: bytes per second read from each client.",
+    )
+    parser.add_argument(
+        "--global-rate",
+        type=float,
+        help="Server only: messages per second read from all clients together.",
+    )
+    parser.add_argument(
+        "--global-byte-rate",
+        type=float,
+        help="Server only: bytes per second read from all clients together.",
+    )
+    parser.add_argument(
+        "--history-bytes",
+        type=int,
+        default=HISTORY_MAX_BYTES,
+        help="Server only: memory for recent room messages, 0 to keep none.",
+    )
+    parser.add_argument(
+        "--history-log",
+        help="Server only: also append room messages to this memory-mapped log.",
+    )
+    parser.add_argument(
+        "--since",
+        type=int,
+        help="Client only: replay the room messages missed after this seq.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Server only: worker processes sharing the port (Linux, SO_REUSEPORT).",
+    )
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    limits = {
+        "heartbeat": args.heartbeat or None,
+        "idle_timeout": args.idle_timeout or None,
+        "write_timeout": args.write_timeout or None,
+        "max_connections": args.max_connections,
+        "accept_rate": args.accept_rate,
+        "client_rate": args.client_rate,
+        "client_byte_rate": args.client_byte_rate,
+        "global_rate": args.global_rate,
+        "global_byte_rate": args.global_byte_rate,
+        "history_bytes": args.history_bytes,
+        "history_log": args.history_log,
+    }
+    if is_unix_address(args.host) and args.workers > 1:
+        parser.error("--workers needs a TCP host, Unix sockets cannot share a port")
 
-    if args.name == CHAT_SERVER_NAME:
-        server = ChatServer(args.port)
+    if args.name == CHAT_SERVER_NAME and args.workers > 1:
+        configure_logging(args.log_level, args.log_sample)
+        PROFILER.output = args.profile_output
+        install_profiler_signal()  # Inherited, signal a worker to profile it
+        run_cluster(
+            args.port,
+            args.workers,
+            stats_port=args.stats_port,
+            host=args.host,
+            max_queue=args.max_queue,
+            slow_policy=args.slow_policy,
+            **limits,
+        )
+    elif args.name == CHAT_SERVER_NAME:
+        apply_metrics_arguments(args)
+        server = ChatServer(
+            args.port,
+            max_queue=args.max_queue,
+            slow_policy=args.slow_policy,
+            host=args.host,
+            **limits,
+        )
         server.run()
     else:
-        client = ChatClient(name=args.name, port=args.port)
+        client = ChatClient(
+            name=args.name,
+            port=args.port,
+            host=args.host,
+            legacy=args.legacy,
+            since=args.since,
+        )
         client.run()
@@ -1,7 +1,12 @@
 import os
+import signal
 import socket
 import threading
 import socketserver
+import argparse
+import time
+
+from helpers.metrics import *
 
 HOST = "localhost"
 PORT = 0
@@ -29,19 +34,156 @@ class Client:
 
 class ServerHandler(socketserver.BaseRequestHandler):
     def handle(self) -> None:
-        data = self.request.recv(BUFFER_SIZE).decode("utf-8")
+        # Servers without MetricsMixIn are labelled by their class name
+        label = getattr(self.server, "metrics_label", type(self.server).__name__)
+        tracing = PROFILER.enabled
+        if tracing:
+            lap = time.perf_counter_ns()
+        raw = self.request.recv(BUFFER_SIZE)
+        if tracing:
+            lap = PROFILER.lap(label, "recv", lap)
+        data = raw.decode("utf-8")
         pid = os.getpid()
         response = f"{pid}: {data}"
-        print(f"Server sending response [PID: data] = [{response}]")
-        self.request.send(response.encode("utf-8"))
+        if should_log():
+            packet_log.info("Server sending response [PID: data] = [%s]", response)
+        payload = response.encode("utf-8")
+        if tracing:
+            lap = PROFILER.lap(label, "encode", lap)
+        sent = self.request.send(payload)
+        if tracing:
+            PROFILER.lap(label, "send", lap)
+        METRICS.inc_many(
+            {"messages": 1, "bytes_received": len(raw), "bytes_sent": sent},
+            server=label,
+        )
+
+
+class Server(MetricsMixIn, socketserver.ForkingMixIn, socketserver.TCPServer):
+    pass
 
 
-class Server(socketserver.ForkingMixIn, socketserver.TCPServer):
+class PreForkMixIn:
+    """Mix-in class to serve requests from a pool of pre-forked workers.
+
+    `workers` processes are forked up front and all accept on the inherited
+    listening socket, so no fork happens per request. A worker exits after
+    `max_requests` requests (0 for never) and is respawned, as is any worker
+    that crashes. Each worker runs `threads_per_worker` accepting threads.
+    """
+
+    workers = 4
+    max_requests = 0
+    threads_per_worker = 1
+
+    def server_activate(self) -> None:
+        super().server_activate()
+        self.children = set()
+        # Workers hold the read end and exit on EOF, i.e. once the parent is gone
+        self._lifeline, self._lifeline_w = os.pipe()
+        self._stop_request = threading.Event()
+        self._stopped = threading.Event()
+
+    def spawn_worker(self) -> None:
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.close(self._lifeline_w)
+            threading.Thread(target=self.watch_parent, daemon=True).start()
+            self.run_worker()
+            status = 0
+        finally:
+            os._exit(status)
+
+    def watch_parent(self) -> None:
+        os.read(self._lifeline, 1)
+        os._exit(0)
+
+    def run_worker(self) -> None:
+        """Accept and handle requests on every thread until the budget is spent."""
+        budget = [self.max_requests or -1]
+        lock = threading.Lock()
+
+        def accept_loop() -> None:
+            while True:
+                with lock:
+                    if budget[0] == 0:
+                        return
+                    budget[0] -= 1
+                try:
+                    request, client_address = self.get_request()
+                except OSError:
+                    return
+                if self.verify_request(request, client_address):
+                    try:
+                        self.finish_request(request, client_address)
+                    except Exception:
+                        self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+        threads = [
+            threading.Thread(target=accept_loop, daemon=True)
+            for _ in range(self.threads_per_worker - 1)
+        ]
+        for thread in threads:
+            thread.start()
+        accept_loop()
+        for thread in threads:
+            thread.join()
+
+    def reap_workers(self) -> None:
+        """Forget workers that exited, they are respawned by serve_forever."""
+        for pid in list(self.children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                self.children.discard(pid)
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        self._stopped.clear()
+        try:
+            while not self._stop_request.is_set():
+                self.reap_workers()
+                while len(self.children) < self.workers:
+                    self.spawn_worker()
+                self._stop_request.wait(poll_interval)
+        finally:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in self.children:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.children.clear()
+            self._stop_request.clear()
+            self._stopped.set()
+
+    def shutdown(self) -> None:
+        self._stop_request.set()
+        self._stopped.wait()
+
+    def server_close(self) -> None:
+        super().server_close()
+        os.close(self._lifeline)
+        os.close(self._lifeline_w)
+
+
+class PreForkServer(MetricsMixIn, PreForkMixIn, socketserver.TCPServer):
     pass
 
 
-def main() -> None:
-    server = Server((HOST, PORT), ServerHandler)
+def main(server_class=Server) -> None:
+    server = server_class((HOST, PORT), ServerHandler)
     ip, port = server.server_address
     thread = threading.Thread(target=server.serve_forever)
     thread.setDaemon(True)
@@ -63,4 +205,30 @@ def main() -> None:
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Forking echo server example")
+    parser.add_argument(
+        "--prefork",
+        type=int,
+        default=0,
+        help="Serve from this many pre-forked workers instead of a fork per request.",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="Threads per pre-forked worker."
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=0,
+        help="Requests before a pre-forked worker is respawned (0 for never).",
+    )
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    apply_metrics_arguments(args)
+
+    if args.prefork:
+        PreForkServer.workers = args.prefork
+        PreForkServer.threads_per_worker = args.threads
+        PreForkServer.max_requests = args.max_requests
+        main(PreForkServer)
+    else:
+        main()
@@ -1,40 +1,222 @@
+import errno
+import ipaddress
+import selectors
 import socket
+import threading
+import time
+from collections import OrderedDict, deque
 
+from helpers.transport import *
 
-def scan_tcp_port(ip, port) -> bool:
-    """Check if a TCP server is running by attempting to connect."""
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
-            tcp_sock.settimeout(1)
-            tcp_sock.connect((ip, port))
-            return True
-    except (socket.timeout, ConnectionRefusedError):
-        return False
-    except socket.error:
-        return False
 
+def _expand_targets(targets):
+    """Yield addresses from a host, a CIDR network or an iterable of them."""
+    if isinstance(targets, str):
+        targets = [targets]
+    for target in targets:
+        if "/" in target:
+            network = ipaddress.ip_network(target, strict=False)
+            hosts = list(network.hosts()) or [network.network_address]
+            yield from (str(host) for host in hosts)
+        else:
+            yield target
 
-def scan_udp_port(ip, port) -> bool:
-    """Check if a UDP server is running by sending a ping message."""
+
+def _start_probe(ip, port, protocol):
+    """Open a non-blocking probe socket, returning (sock, result or None)."""
+    kind = socket.SOCK_STREAM if protocol == "tcp" else socket.SOCK_DGRAM
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.setblocking(False)
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(1)  # Set timeout for response
-        server_address = (ip, port)
+        err = sock.connect_ex((ip, port))
+        if protocol == "udp":
+            sock.send(b"ping")  # Expect a "pong" response
+            return sock, None
+    except OSError:
+        sock.close()
+        return None, False
+    if err == 0:
+        sock.close()
+        return None, True
+    if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+        sock.close()
+        return None, False
+    return sock, None
 
-        # Send a "ping" message
-        sock.sendto(b"ping", server_address)
 
-        # Expect a "pong" response
-        data, server = sock.recvfrom(1024)
-        if data.decode("utf-8") == "pong":
-            return True
-        return False
-    except socket.timeout:
-        return False
-    except socket.error as e:
+def _finish_probe(sock, protocol) -> bool:
+    """Read the outcome of a probe whose socket became ready."""
+    if protocol == "tcp":
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+    try:
+        return sock.recv(1024) == b"pong"
+    except OSError:  # ICMP port unreachable surfaces as ConnectionRefusedError
         return False
-    finally:
-        sock.close()
+
+
+def _run_probes(probes, concurrency=256, rate=None, timeout=1.0):
+    """Run (ip, port, protocol) probes concurrently, yielding them with results."""
+    interval = 1 / rate if rate else 0
+    next_start = time.monotonic()
+    pending = {}  # sock -> (ip, port, protocol)
+    deadlines = deque()  # (deadline, sock), in start order as timeouts are equal
+    exhausted = False
+    probes = iter(probes)
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            while True:
+                now = time.monotonic()
+                while not exhausted and len(pending) < concurrency:
+                    if now < next_start:
+                        break
+                    probe = next(probes, None)
+                    if probe is None:
+                        exhausted = True
+                        break
+                    next_start = max(next_start + interval, now)
+                    sock, result = _start_probe(*probe)
+                    if sock is None:
+                        yield (*probe, result)
+                        continue
+                    if probe[2] == "tcp":
+                        selector.register(sock, selectors.EVENT_WRITE)
+                    else:
+                        selector.register(sock, selectors.EVENT_READ)
+                    pending[sock] = probe
+                    deadlines.append((now + timeout, sock))
+
+                if exhausted and not pending:
+                    return
+
+                # Sleep until a probe is ready, times out or may be started
+                wake = deadlines[0][0] if deadlines else now + timeout
+                if not exhausted and len(pending) < concurrency:
+                    wake = min(wake, next_start)
+                for key, _ in selector.select(max(0, wake - time.monotonic())):
+                    sock = key.fileobj
+                    probe = pending.pop(sock)
+                    result = _finish_probe(sock, probe[2])
+                    selector.unregister(sock)
+                    sock.close()
+                    yield (*probe, result)
+
+                now = time.monotonic()
+                while deadlines and (
+                    deadlines[0][0] <= now or deadlines[0][1] not in pending
+                ):
+                    _, sock = deadlines.popleft()
+                    if sock in pending:
+                        selector.unregister(sock)
+                        sock.close()
+                        yield (*pending.pop(sock), False)
+        finally:
+            for sock in pending:
+                sock.close()
+
+
+def scan_ports(targets, ports, protocol="tcp", concurrency=256, rate=None, timeout=1.0):
+    """Probe every target/port pair concurrently, yielding (ip, port, is_open).
+
+    Targets may be a host, a CIDR network such as "192.168.1.0/24", or an
+    iterable of either. Results are yielded as probes finish, not in order.
+    At most `concurrency` probes are in flight, at most `rate` are started
+    per second (unlimited if None), and each gives up after `timeout` seconds.
+    """
+    if protocol not in ("tcp", "udp"):
+        raise ValueError("Invalid protocol specified. Use 'tcp' or 'udp'.")
+    if isinstance(ports, int):
+        ports = [ports]
+    probes = ((ip, port, protocol) for ip in _expand_targets(targets) for port in ports)
+    for ip, port, _, is_open in _run_probes(probes, concurrency, rate, timeout):
+        yield ip, port, is_open
+
+
+class ProbeCache:
+    """Thread-safe TTL and LRU cache of probe results keyed by (ip, port, protocol).
+
+    Closed ports are kept for `negative_ttl` only, so a server that has just
+    been started is noticed quickly.
+    """
+
+    def __init__(self, ttl=30.0, negative_ttl=2.0, maxsize=1024) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key -> (expires, is_open)
+        self.lock = threading.Lock()
+
+    def get(self, ip, port, protocol):
+        """Return the cached result, or None when missing or expired."""
+        key = (ip, port, protocol)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, ip, port, protocol, is_open) -> None:
+        ttl = self.ttl if is_open else self.negative_ttl
+        with self.lock:
+            self.entries[(ip, port, protocol)] = (time.monotonic() + ttl, is_open)
+            self.entries.move_to_end((ip, port, protocol))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, ip, port, protocol=None) -> None:
+        """Forget one protocol, or both when protocol is None."""
+        with self.lock:
+            for proto in (protocol,) if protocol else ("tcp", "udp"):
+                self.entries.pop((ip, port, proto), None)
+
+
+PROBE_CACHE = ProbeCache()
+
+
+def _unix_protocols(ip) -> tuple[bool, bool]:
+    """Return (stream_open, datagram_open) for a Unix socket address.
+
+    Connecting with the wrong socket type fails with EPROTOTYPE, so a
+    connect() per type tells which kind of server is listening.
+    """
+    results = []
+    for kind in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+        with socket.socket(socket.AF_UNIX, kind) as sock:
+            try:
+                sock.connect(unix_path(ip))
+                results.append(True)
+            except OSError:
+                results.append(False)
+    return results[0], results[1]
+
+
+def detect_protocols(ip, port, cache=PROBE_CACHE) -> tuple[bool, bool]:
+    """Return (tcp_open, udp_open), probing both protocols in parallel on a miss.
+
+    For a Unix socket address these are (stream_open, datagram_open).
+    """
+    if is_unix_address(ip):
+        return _unix_protocols(ip)
+    results = {proto: cache.get(ip, port, proto) for proto in ("tcp", "udp")}
+    misses = [(ip, port, proto) for proto, hit in results.items() if hit is None]
+    for _, _, proto, is_open in _run_probes(misses):
+        cache.put(ip, port, proto, is_open)
+        results[proto] = is_open
+    return results["tcp"], results["udp"]
+
+
+def scan_tcp_port(ip, port) -> bool:
+    """Check if a TCP server is running by attempting to connect."""
+    return next(scan_ports(ip, [port], "tcp"))[2]
+
+
+def scan_udp_port(ip, port) -> bool:
+    """Check if a UDP server is running by sending a ping message."""
+    return next(scan_ports(ip, [port], "udp"))[2]
 
 
 def is_valid_ip(ip) -> bool:
@@ -51,23 +233,121 @@ def is_valid_port(port):  # -> Any:
     return 1 <= port <= 65535
 
 
-def find_available_port(ip, port, protocol="tcp"):  # Added protocol argument
-    """Find the next available port if the default one is in use."""
-    while True:
-        try:
-            if protocol == "tcp":
-                # Check for TCP availability
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            elif protocol == "udp":
-                # Check for UDP availability
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+class PortAllocator:
+    """Hands out free ports from a bitmap of the kernel's in-use ports.
+
+    The bitmap is rebuilt in bulk from /proc/net/{tcp,udp}[6] at most every
+    `max_age` seconds. Allocated ports stay reserved, so they are not handed
+    out twice, until release() is called once the server has bound them or
+    `reserve_for` seconds pass. Without /proc every candidate is checked with
+    a bind instead, and the kernel picks a port (bind to 0) as a last resort.
+    """
+
+    PROC_FILES = {
+        "tcp": ("/proc/net/tcp", "/proc/net/tcp6"),
+        "udp": ("/proc/net/udp", "/proc/net/udp6"),
+    }
+
+    def __init__(self, max_age=1.0, reserve_for=30.0) -> None:
+        self.max_age = max_age
+        self.reserve_for = reserve_for
+        self.bitmaps = {}  # protocol -> bytearray, 1 for every used port
+        self.loaded = {}  # protocol -> monotonic time of the last refresh
+        self.reserved = {"tcp": {}, "udp": {}}  # port -> reservation expiry
+        self.lock = threading.Lock()
+
+    def _read_proc(self, protocol):
+        """Return a bitmap of the local ports in use, or None without /proc."""
+        bitmap = bytearray(65536)
+        bitmap[0] = 1
+        found = False
+        for path in self.PROC_FILES[protocol]:
+            try:
+                with open(path) as table:
+                    next(table, None)  # Header line
+                    for line in table:
+                        local = line.split(None, 2)[1]
+                        bitmap[int(local.rsplit(":", 1)[1], 16)] = 1
+                found = True
+            except (OSError, IndexError, ValueError):
+                continue
+        return bitmap if found else None
+
+    def _bitmap(self, protocol):
+        now = time.monotonic()
+        if now - self.loaded.get(protocol, -self.max_age) >= self.max_age:
+            self.bitmaps[protocol] = self._read_proc(protocol)
+            self.loaded[protocol] = now
+            reserved = self.reserved[protocol]
+            for port, expires in list(reserved.items()):
+                if expires <= now:
+                    del reserved[port]
+        return self.bitmaps[protocol]
+
+    def allocate(self, ip, port=1024, protocol="tcp") -> int:
+        """Reserve and return the first free port at or above `port`."""
+        if protocol not in self.PROC_FILES:
+            raise ValueError("Invalid protocol specified. Use 'tcp' or 'udp'.")
+        with self.lock:
+            bitmap = self._bitmap(protocol)
+            reserved = self.reserved[protocol]
+            if bitmap is not None:
+                candidate = bitmap.find(0, port)
+                while candidate in reserved:
+                    candidate = bitmap.find(0, candidate + 1)
             else:
-                raise ValueError("Invalid protocol specified. Use 'tcp' or 'udp'.")
+                candidate = next(
+                    (
+                        p
+                        for p in range(port, 65536)
+                        if p not in reserved and _can_bind(ip, p, protocol)
+                    ),
+                    -1,
+                )
+            if candidate == -1:
+                candidate = _kernel_port(ip, protocol)
+            reserved[candidate] = time.monotonic() + self.reserve_for
+            if bitmap is not None:
+                bitmap[candidate] = 1
+            return candidate
+
+    def release(self, port, protocol="tcp") -> None:
+        """Drop a reservation, normally once the server has bound the port."""
+        with self.lock:
+            self.reserved.get(protocol, {}).pop(port, None)
 
+
+def _socket_for(protocol):
+    if protocol == "tcp":
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+def _can_bind(ip, port, protocol) -> bool:
+    with _socket_for(protocol) as sock:
+        try:
             sock.bind((ip, port))
-            sock.close()
-            return port
+            return True
         except OSError:
-            # Increment port number if it's in use and try again
-            port += 1
-            continue
+            return False
+
+
+def _kernel_port(ip, protocol) -> int:
+    """Let the kernel choose a free ephemeral port."""
+    with _socket_for(protocol) as sock:
+        sock.bind((ip, 0))
+        return sock.getsockname()[1]
+
+
+PORT_ALLOCATOR = PortAllocator()
+
+
+def find_available_port(ip, port, protocol="tcp"):  # Added protocol argument
+    """Find the next available port if the default one is in use.
+
+    The port stays reserved until the server calls PORT_ALLOCATOR.release().
+    Unix socket addresses have no port, which is returned unchanged.
+    """
+    if is_unix_address(ip):
+        return port
+    return PORT_ALLOCATOR.allocate(ip, port, protocol)
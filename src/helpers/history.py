@@ -0,0 +1,127 @@
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
+from operator import itemgetter
+
+HISTORY_MAX_BYTES = 4 * 1024 * 1024  # Memory for the ring of recent messages
+HISTORY_ENTRY_OVERHEAD = 128  # Rough bytes per entry besides its text
+# Log records are a header then "<targets>\0<msg>" in UTF-8. The file grows
+# in zero-filled steps, so a zero length marks the end of the log. The length
+# is written last, a record cut short by a crash is never read back.
+LOG_RECORD = struct.Struct("!QI")  # Sequence number, payload length
+LOG_GROWTH = 1024 * 1024
+LOG_INDEX_EVERY = 256  # Records between two entries of the log index
+
+
+class ChatHistory:
+    """Recent broadcasts with sequence numbers, for clients catching up.
+
+    Messages get sequence numbers counting up from 1, or the ones a caller
+    hands out, which must grow but may skip some. The newest messages are
+    kept in memory up to `max_bytes`. With a `path`, every message is also
+    appended to a memory-mapped log, so older messages are still served
+    from disk and numbering carries on after a restart.
+    """
+
+    def __init__(self, max_bytes=HISTORY_MAX_BYTES, path=None) -> None:
+        self.max_bytes = max_bytes
+        self.entries = deque()  # (seq, targets, msg), oldest first
+        self.size = 0
+        self.last_seq = 0
+        self.log = None
+        if path is not None:
+            self._open_log(path)
+
+    def _open_log(self, path) -> None:
+        self.file = open(path, "a+b")
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.file.truncate(LOG_GROWTH)
+        self.log = mmap.mmap(self.file.fileno(), 0)
+        self.index = []  # (seq, offset) of every LOG_INDEX_EVERY-th record
+        self.records = 0
+        self.end = 0
+        for seq, targets, msg, offset in self._scan(0):
+            if self.records % LOG_INDEX_EVERY == 0:
+                self.index.append((seq, offset))
+            self.records += 1
+            self._remember(seq, targets, msg)
+            self.last_seq = seq
+            self.end = offset
+        if self.last_seq:
+            self.end += LOG_RECORD.size + LOG_RECORD.unpack_from(self.log, self.end)[1]
+
+    @staticmethod
+    def _payload(targets, msg) -> bytes:
+        return f"{','.join(targets)}\0{msg}".encode("utf-8")
+
+    def _scan(self, offset):
+        """Yield (seq, targets, msg, offset) for the log records from `offset` on."""
+        while offset + LOG_RECORD.size <= len(self.log):
+            seq, length = LOG_RECORD.unpack_from(self.log, offset)
+            if not length:
+                return
+            start = offset + LOG_RECORD.size
+            payload = str(self.log[start : start + length], "utf-8", errors="replace")
+            targets, _, msg = payload.partition("\0")
+            yield seq, tuple(targets.split(",")), msg, offset
+            offset = start + length
+
+    def _remember(self, seq, targets, msg) -> None:
+        self.entries.append((seq, targets, msg))
+        self.size += len(msg) + HISTORY_ENTRY_OVERHEAD
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self.size -= len(self.entries.popleft()[2]) + HISTORY_ENTRY_OVERHEAD
+
+    def append(self, targets, msg: str, seq: int | None = None) -> int:
+        """Record a message sent to `targets` and return its sequence number."""
+        self.last_seq = self.last_seq + 1 if seq is None else seq
+        targets = tuple(targets)
+        self._remember(self.last_seq, targets, msg)
+        if self.log is not None:
+            payload = self._payload(targets, msg)
+            need = self.end + LOG_RECORD.size + len(payload) + LOG_RECORD.size
+            if need > len(self.log):
+                self.log.resize(need + LOG_GROWTH - need % LOG_GROWTH)  # And the file
+            start = self.end + LOG_RECORD.size
+            self.log[start : start + len(payload)] = payload
+            LOG_RECORD.pack_into(self.log, self.end, self.last_seq, len(payload))
+            if self.records % LOG_INDEX_EVERY == 0:
+                self.index.append((self.last_seq, self.end))
+            self.records += 1
+            self.end = start + len(payload)
+        return self.last_seq
+
+    @property
+    def first_seq(self) -> int:
+        """The oldest sequence number still available."""
+        if self.log is not None and self.index:
+            return self.index[0][0]
+        return self.entries[0][0] if self.entries else self.last_seq + 1
+
+    def since(self, seq: int, limit: int) -> list:
+        """Return up to `limit` (seq, targets, msg) entries following `seq`."""
+        if not self.entries or seq >= self.last_seq:
+            return []
+        if seq >= self.entries[0][0] or self.log is None:
+            start = bisect_right(self.entries, seq, key=itemgetter(0))
+            return list(islice(self.entries, start, start + limit))
+        # Older than the memory ring: read the log from the nearest index entry
+        nearest = bisect_right(self.index, seq, key=itemgetter(0))
+        offset = self.index[max(nearest - 1, 0)][1]
+        entries = []
+        for found, targets, msg, _ in self._scan(offset):
+            if found > seq:
+                entries.append((found, targets, msg))
+                if len(entries) == limit:
+                    break
+        return entries
+
+    def close(self) -> None:
+        if self.log is not None:
+            self.log.flush()
+            self.log.close()
+            self.file.close()
+            self.log = None
@@ -0,0 +1,132 @@
+import os
+import selectors
+import socket
+import threading
+
+
+class StopEvent:
+    """A threading.Event that can also wake up a selector.
+
+    set() makes fileno() readable, through an eventfd on Linux or a socket
+    pair elsewhere, so servers block on their sockets and this descriptor
+    together and stop at once instead of polling is_set() on a timeout.
+    The descriptor stays readable until clear(), so it wakes every waiter.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        if hasattr(os, "eventfd"):
+            self._reader = None
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._reader, self._writer = socket.socketpair()
+            self._reader.setblocking(False)
+            self._writer.setblocking(False)
+            self._fd = self._reader.fileno()
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def set(self) -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            if self._reader is None:
+                os.eventfd_write(self._fd, 1)
+            else:
+                self._writer.send(b"\0")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._event.clear()
+            try:
+                if self._reader is None:
+                    os.eventfd_read(self._fd)
+                else:
+                    self._reader.recv(64)
+            except BlockingIOError:
+                pass
+
+    def wait(self, timeout=None) -> bool:
+        return self._event.wait(timeout)
+
+    def close(self) -> None:
+        if self._reader is None:
+            os.close(self._fd)
+        else:
+            self._reader.close()
+            self._writer.close()
+
+
+def stop_selector(sock, stop_event=None) -> selectors.BaseSelector:
+    """Return a selector watching `sock` for reads, and `stop_event` if it has an fd."""
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    if hasattr(stop_event, "fileno"):
+        selector.register(stop_event, selectors.EVENT_READ)
+    return selector
+
+
+def poll_timeout(stop_event=None):
+    """How long to block between is_set() checks: forever unless the event has no fd.
+
+    A plain threading.Event cannot wake a selector, so servers given one
+    keep checking it every second as they used to.
+    """
+    if stop_event is None or hasattr(stop_event, "fileno"):
+        return None
+    return 1
+
+
+class ServerController:
+    """Run any number of servers on threads and stop them immediately.
+
+    Every server is started with its own StopEvent as `stop_event`, so
+    stop() wakes the chosen servers (all by default) at once, then joins
+    their threads.
+    """
+
+    def __init__(self) -> None:
+        self.servers = {}  # Name -> (thread, StopEvent)
+        self.lock = threading.Lock()
+
+    def start(self, name: str, target, *args, **kwargs) -> threading.Thread:
+        """Run target(*args, stop_event=..., **kwargs) on a thread called `name`."""
+        with self.lock:
+            running = self.servers.get(name)
+            if running is not None and running[0].is_alive():
+                raise ValueError(f"Server {name} is already running")
+            stop_event = StopEvent()
+            thread = threading.Thread(
+                target=target,
+                args=args,
+                kwargs={**kwargs, "stop_event": stop_event},
+                name=name,
+                daemon=True,
+            )
+            self.servers[name] = (thread, stop_event)
+        thread.start()
+        return thread
+
+    def running(self) -> list:
+        with self.lock:
+            return [name for name, (t, _) in self.servers.items() if t.is_alive()]
+
+    def stop(self, *names, timeout=None) -> None:
+        """Stop the named servers, or all of them, and wait for them to exit."""
+        with self.lock:
+            names = names or tuple(self.servers)
+            stopping = [
+                self.servers.pop(name) for name in names if name in self.servers
+            ]
+        for _, stop_event in stopping:
+            stop_event.set()
+        for thread, stop_event in stopping:
+            thread.join(timeout)
+            if not thread.is_alive():
+                stop_event.close()
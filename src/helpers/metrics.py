@@ -0,0 +1,597 @@
+import atexit
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+PERCENTILES = {"p50": 50, "p90": 90, "p99": 99, "p999": 99.9}
+METRIC_PREFIX = "netprog"
+
+
+class Histogram:
+    """Log-linear latency histogram in the spirit of HdrHistogram.
+
+    Values (nanoseconds) keep their top SUB_BITS significant bits, which
+    bounds the relative error of every recorded value to under 1%.
+    """
+
+    SUB_BITS = 8
+
+    def __init__(self) -> None:
+        self.counts = {}  # (exponent, mantissa) -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        shift = max(0, value.bit_length() - self.SUB_BITS)
+        key = (shift, value >> shift)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram") -> None:
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, pct: float) -> int:
+        """Return the value below which `pct` percent of the samples fall."""
+        if not self.count:
+            return 0
+        rank = pct / 100 * self.count
+        seen = 0
+        for shift, mantissa in sorted(self.counts, key=lambda k: k[1] << k[0]):
+            seen += self.counts[(shift, mantissa)]
+            if seen >= rank:
+                # Middle of the bucket, clamped to what was actually recorded
+                value = (mantissa << shift) + ((1 << shift) >> 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """Return min, mean, max and percentiles in microseconds."""
+        summary = {
+            label: round(self.percentile(pct) / 1000, 1)
+            for label, pct in PERCENTILES.items()
+        }
+        summary["min"] = round((self.min or 0) / 1000, 1)
+        summary["mean"] = round(self.total / max(self.count, 1) / 1000, 1)
+        summary["max"] = round(self.max / 1000, 1)
+        return summary
+
+
+def _series(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def _prometheus_labels(labels, **extra) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """Registry of counters, gauges and latency histograms shared by the servers.
+
+    A series is a metric name plus labels such as server="udp" or
+    stage="recv"; latencies are recorded in nanoseconds. Single threaded
+    servers can keep their own counts and register a collector instead,
+    which is only called when the registry is read. Forked workers update
+    their own copy of the registry.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}  # (name, labels) -> total
+        self.gauges = {}  # (name, labels) -> current value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.collectors = {}  # callable -> labels, returning {name: total}
+
+    def inc(self, name: str, value: int = 1, **labels) -> None:
+        key = _series(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def inc_many(self, counts: dict, **labels) -> None:
+        """Add several counters sharing the same labels under one lock."""
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            for name, value in counts.items():
+                key = (name, labels)
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name: str, delta: int, **labels) -> None:
+        """Move a gauge up or down."""
+        key = _series(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name: str, nanoseconds: int, **labels) -> None:
+        key = _series(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(nanoseconds)
+
+    def register(self, collector, **labels) -> None:
+        self.collectors[collector] = tuple(sorted(labels.items()))
+
+    def unregister(self, collector) -> None:
+        self.collectors.pop(collector, None)
+
+    def get(self, name: str, **labels) -> int:
+        """Return the current value of a counter or gauge, 0 if never set."""
+        key = _series(name, labels)
+        return self.collect()[0].get(key, self.gauges.get(key, 0))
+
+    def collect(self) -> tuple:
+        """Return consistent copies of the counters, gauges and histograms."""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                histograms[key] = copy = Histogram()
+                copy.merge(histogram)
+        for collector, labels in list(self.collectors.items()):
+            for name, value in collector().items():
+                key = (name, labels)
+                counters[key] = counters.get(key, 0) + value
+        return counters, gauges, histograms
+
+    def snapshot(self) -> dict:
+        """Return every series as plain data, latencies in microseconds."""
+        counters, gauges, histograms = self.collect()
+        return {
+            "uptime": round(time.time() - self.started, 3),
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(counters.items())
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(gauges.items())
+            ],
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    **histogram.summary(),
+                }
+                for (name, labels), histogram in sorted(histograms.items())
+            ],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Render the registry in the Prometheus text exposition format."""
+        counters, gauges, histograms = self.collect()
+        lines = []
+        typed = set()
+
+        def declare(metric, kind):
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            declare(metric, "counter")
+            lines.append(f"{metric}{_prometheus_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            metric = f"{METRIC_PREFIX}_{name}"
+            declare(metric, "gauge")
+            lines.append(f"{metric}{_prometheus_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            metric = f"{METRIC_PREFIX}_{name}_seconds"
+            declare(metric, "summary")
+            for pct in PERCENTILES.values():
+                quantile = _prometheus_labels(labels, quantile=f"{pct / 100:g}")
+                seconds = histogram.percentile(pct) / 1e9
+                lines.append(f"{metric}{quantile} {seconds:.9f}")
+            rendered = _prometheus_labels(labels)
+            lines.append(f"{metric}_sum{rendered} {histogram.total / 1e9:.9f}")
+            lines.append(f"{metric}_count{rendered} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+
+METRICS = Metrics()
+
+
+class MetricsMixIn:
+    """Mix-in class recording connections, errors and handler latency of a socketserver.
+
+    Series are labelled with `metrics_name`, the class name by default.
+    With ForkingMixIn the handler runs in a child, so only connections are
+    counted by the parent.
+    """
+
+    metrics_name = None
+
+    @property
+    def metrics_label(self) -> str:
+        return self.metrics_name or type(self).__name__
+
+    def verify_request(self, request, client_address) -> bool:
+        # Called once per accepted connection whichever way requests are dispatched
+        METRICS.inc("connections", server=self.metrics_label)
+        return super().verify_request(request, client_address)
+
+    def get_request(self):
+        if not PROFILER.enabled:
+            return super().get_request()
+        start = time.perf_counter_ns()
+        request = super().get_request()
+        PROFILER.lap(self.metrics_label, "accept", start)
+        return request
+
+    def finish_request(self, request, client_address) -> None:
+        start = time.perf_counter_ns()
+        super().finish_request(request, client_address)
+        elapsed = time.perf_counter_ns() - start
+        METRICS.observe("latency", elapsed, server=self.metrics_label, stage="handle")
+        if PROFILER.enabled:
+            PROFILER.record(self.metrics_label, "handle", elapsed)
+
+    def handle_error(self, request, client_address) -> None:
+        METRICS.inc("errors", server=self.metrics_label)
+        super().handle_error(request, client_address)
+
+
+# Per-packet logging, kept apart from the lifecycle messages servers print
+packet_log = logging.getLogger("netprog.packets")
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "off": logging.CRITICAL + 1,
+}
+_log_sample = 1
+_log_seen = itertools.count()
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Write to whatever sys.stdout currently is, the way print does."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value) -> None:
+        pass
+
+
+def configure_logging(level: str = "info", sample: int = 1) -> None:
+    """Set the per-packet log level, "off" to silence it, and log 1 in `sample`."""
+    global _log_sample
+    packet_log.setLevel(LOG_LEVELS[level])
+    _log_sample = max(1, sample)
+
+
+def should_log(level: int = logging.INFO) -> bool:
+    """Tell whether the current packet is to be logged at `level`.
+
+    Cheap enough to call for every packet: nothing is formatted unless
+    the level is enabled and the packet falls in the sample.
+    """
+    if not packet_log.isEnabledFor(level):
+        return False
+    return _log_sample == 1 or next(_log_seen) % _log_sample == 0
+
+
+_handler = _StdoutHandler()
+_handler.setFormatter(logging.Formatter("%(message)s"))
+packet_log.addHandler(_handler)
+packet_log.propagate = False
+configure_logging()
+
+
+# Stage profiling, off until switched on by a signal or a stats command
+class Profiler:
+    """Per-stage timing breakdowns and stack samples, switched on at runtime.
+
+    Instrumented loops read `enabled` once per request and only then take
+    timestamps, so a disabled profiler costs one attribute load. While it
+    runs with an `output` file, a sampler thread also records the stacks
+    of every thread in the folded format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, output=None, interval=0.005) -> None:
+        self.enabled = False
+        self.output = output
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stages = {}  # (server, stage) -> Histogram
+        self.samples = {}  # Folded stack -> count
+        self.started = time.perf_counter_ns()
+        self.stopped = None
+        self.sampler = None
+        self.stop_sampling = threading.Event()
+
+    def record(self, server: str, stage: str, nanoseconds: int) -> None:
+        with self.lock:
+            histogram = self.stages.get((server, stage))
+            if histogram is None:
+                histogram = self.stages[(server, stage)] = Histogram()
+            histogram.record(nanoseconds)
+
+    def lap(self, server: str, stage: str, start: int) -> int:
+        """Record the stage that began at `start` and return the time it ended."""
+        now = time.perf_counter_ns()
+        self.record(server, stage, now - start)
+        return now
+
+    def start(self) -> str:
+        with self.lock:
+            if self.enabled:
+                return "Profiling already running\n"
+            self.stages.clear()
+            self.samples.clear()
+            self.started = time.perf_counter_ns()
+            self.stopped = None
+            self.enabled = True
+        if self.output:
+            self.stop_sampling.clear()
+            self.sampler = threading.Thread(
+                target=self.sample, name="profiler", daemon=True
+            )
+            self.sampler.start()
+        return "Profiling started\n"
+
+    def stop(self) -> str:
+        """Stop profiling, write the stack samples and return the breakdown."""
+        with self.lock:
+            if not self.enabled:
+                return "Profiling is not running\n"
+            self.enabled = False
+            self.stopped = time.perf_counter_ns()
+        if self.sampler is not None:
+            self.stop_sampling.set()
+            self.sampler.join()
+            self.sampler = None
+            self.write_samples(self.output)
+        return self.report()
+
+    def toggle(self) -> str:
+        return self.stop() if self.enabled else self.start()
+
+    def sample(self) -> None:
+        """Count the current stack of every other thread at each interval."""
+        me = threading.get_ident()
+        while not self.stop_sampling.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = code.co_filename.rsplit("/", 1)[-1]
+                    stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                folded = ";".join(reversed(stack))
+                self.samples[folded] = self.samples.get(folded, 0) + 1
+
+    def write_samples(self, path) -> None:
+        with open(path, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        print(f"Wrote {sum(self.samples.values())} stack samples to {path}")
+
+    def report(self) -> str:
+        """Return a table of time spent per stage, as a share of wall time."""
+        end = self.stopped or time.perf_counter_ns()
+        wall = max(end - self.started, 1)
+        with self.lock:
+            stages = sorted(self.stages.items())
+        lines = [
+            f"Profile over {wall / 1e9:.3f}s",
+            f"{'server':>16} {'stage':>10} {'count':>9} {'total ms':>10} "
+            f"{'wall %':>7} {'mean us':>9} {'p99 us':>9}",
+        ]
+        for (server, stage), histogram in stages:
+            summary = histogram.summary()
+            lines.append(
+                f"{server:>16} {stage:>10} {histogram.count:>9} "
+                f"{histogram.total / 1e6:>10.2f} {histogram.total / wall:>7.1%} "
+                f"{summary['mean']:>9.1f} {summary['p99']:>9.1f}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def command(self, action: str = "report") -> str:
+        actions = {"start": self.start, "stop": self.stop, "report": self.report}
+        if action not in actions:
+            raise ValueError(f"profile expects one of: {', '.join(actions)}")
+        return actions[action]()
+
+
+PROFILER = Profiler()
+
+
+# The signal may land while the main thread holds PROFILER.lock or is in the
+# middle of a print, so the handler only writes a byte to this pipe. A helper
+# thread reads it and does the actual toggle and report.
+_profiler_wakeup = None
+
+
+def _watch_profiler_signal(read_fd: int) -> None:
+    while os.read(read_fd, 1):
+        print(PROFILER.toggle(), end="", flush=True)
+
+
+def _start_profiler_watcher() -> None:
+    global _profiler_wakeup
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+    if _profiler_wakeup is not None:
+        os.close(_profiler_wakeup)  # A forked child's copy of the parent's pipe
+    _profiler_wakeup = write_fd
+    threading.Thread(
+        target=_watch_profiler_signal,
+        args=(read_fd,),
+        name="profiler-signal",
+        daemon=True,
+    ).start()
+
+
+def _on_profiler_signal(signum, frame) -> None:
+    try:
+        os.write(_profiler_wakeup, b"\0")
+    except BlockingIOError:
+        pass  # Toggles are already queued up
+
+
+def install_profiler_signal(signum=getattr(signal, "SIGUSR1", None)) -> None:
+    """Toggle PROFILER on a signal, printing the breakdown when it stops.
+
+    Must be called from the main thread. A no-op where the signal is
+    unavailable, e.g. SIGUSR1 on Windows. Forked children, such as cluster
+    workers, get a watcher thread of their own.
+    """
+    if signum is None:
+        return
+    if _profiler_wakeup is None:
+        _start_profiler_watcher()
+        os.register_at_fork(after_in_child=_start_profiler_watcher)
+    signal.signal(signum, _on_profiler_signal)
+
+
+# Local stats endpoint: a line based command, or an HTTP GET for scrapers
+STATS_COMMANDS = {
+    "json": lambda metrics: metrics.to_json() + "\n",
+    "prometheus": lambda metrics: metrics.to_prometheus(),
+    "metrics": lambda metrics: metrics.to_prometheus(),
+    "profile": lambda metrics, action="report": PROFILER.command(action),
+}
+
+
+class StatsHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        line = self.rfile.readline(1024).decode("ascii", errors="replace").strip()
+        http = line.startswith("GET ")
+        if http:
+            while self.rfile.readline(1024).strip():
+                pass  # Skip the request headers
+            path = line.split()[1] if len(line.split()) > 1 else "/"
+            words = path.strip("/").split("/")
+        else:
+            words = line.split()
+        command = STATS_COMMANDS.get(words[0] if words else "json")
+        if command is None:
+            status = "404 Not Found"
+            body = f"Unknown command, expected one of: {', '.join(STATS_COMMANDS)}\n"
+        else:
+            try:
+                status, body = "200 OK", command(self.server.metrics, *words[1:])
+            except (TypeError, ValueError) as e:
+                status, body = "400 Bad Request", f"Error: {e}\n"
+        payload = body.encode("utf-8")
+        if http:
+            self.wfile.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n\r\n".encode("ascii")
+            )
+        self.wfile.write(payload)
+
+
+class StatsServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, metrics=None) -> None:
+        super().__init__(server_address, StatsHandler)
+        self.metrics = metrics or METRICS
+
+
+def start_stats_server(ip="127.0.0.1", port=0, metrics=None) -> StatsServer:
+    """Serve the registry on a local TCP port from a daemon thread."""
+    server = StatsServer((ip, port), metrics)
+    thread = threading.Thread(target=server.serve_forever, name="stats", daemon=True)
+    thread.start()
+    print(f"Stats available on {ip} port {server.server_address[1]}")
+    return server
+
+
+def query_stats(ip, port, command="json") -> str:
+    """Send one command to a stats server and return its reply."""
+    with socket.create_connection((ip, port), timeout=5) as sock:
+        sock.sendall(command.encode("ascii") + b"\n")
+        chunks = []
+        while chunk := sock.recv(65536):
+            chunks.append(chunk)
+    return b"".join(chunks).decode("utf-8")
+
+
+def add_metrics_arguments(parser) -> None:
+    """Add the stats endpoint, packet log and profiler options to a CLI."""
+    parser.add_argument(
+        "--stats-port",
+        type=int,
+        default=None,
+        help="Serve metrics as JSON or Prometheus text on this local port.",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=LOG_LEVELS,
+        default="info",
+        help="Level of the per-packet log, 'off' to silence it.",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=int,
+        default=1,
+        help="Log only one packet in this many.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile stages from the start, SIGUSR1 or 'profile start' also do.",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default=None,
+        help="Also write folded stack samples (flamegraph format) to this file.",
+    )
+
+
+def apply_metrics_arguments(args):
+    """Configure logging and profiling from parsed options, start the stats server."""
+    configure_logging(args.log_level, args.log_sample)
+    PROFILER.output = args.profile_output
+    install_profiler_signal()
+    atexit.register(lambda: PROFILER.enabled and print(PROFILER.stop(), end=""))
+    if args.profile:
+        PROFILER.start()
+    if args.stats_port is not None:
+        return start_stats_server(port=args.stats_port)
+    return None
@@ -0,0 +1,36 @@
+class TokenBucket:
+    """Allows `rate` units per second on average and bursts of up to `burst`.
+
+    Callers pass in the current time, so one clock read per event loop tick
+    serves every bucket. consume() may overdraw the bucket: work that has
+    already happened is charged in full, and the debt says how long to wait.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float | None = None, now=0.0) -> None:
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, not {rate}")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.stamp = now
+
+    def refill(self, now: float) -> None:
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def try_take(self, amount: float, now: float) -> bool:
+        """Take `amount` tokens if there are enough, without going into debt."""
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def consume(self, amount: float, now: float) -> float:
+        """Take `amount` tokens, return the seconds until the debt is paid off."""
+        self.refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
@@ -1,11 +1,28 @@
+import asyncio
+import functools
+import mmap
+import os
+import signal
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+
 from helpers.checkers import *
+from helpers.lifecycle import *
+from helpers.metrics import *
+from helpers.shm import *
+
+# Session framing: every pipelined message is prefixed with its length
+SESSION_HEADER = struct.Struct("!I")
+SESSION_WINDOW = 64  # Messages in flight before the client drains replies
 
 
 def tcp_echo_client(ip, port, message):  # -> Any:
     """TCP Echo Client with protocol mismatch detection"""
 
-    tcp_open = scan_tcp_port(ip, port)  # Scan for TCP server
-    udp_open = scan_udp_port(ip, port)  # Scan for UDP server
+    tcp_open, udp_open = detect_protocols(ip, port)  # Cached, probed in parallel
 
     if not tcp_open and udp_open:
         print(
@@ -17,80 +34,839 @@ def tcp_echo_client(ip, port, message):  # -> Any:
         return
 
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_address = (ip, port)
+        sock = client_socket(ip)
+        server_address = socket_address(ip, port)
         print(f"Connecting to {ip} port {port}")
         sock.connect(server_address)
 
         try:
             print(f"Sending: {message}")
-            sock.sendall(message.encode("utf-8"))
+            payload = message.encode("utf-8")
+            sock.sendall(payload)
 
+            chunks = []
             amount_received = 0
-            amount_expected = len(message)
+            amount_expected = len(payload)
 
             while amount_received < amount_expected:
-                data = sock.recv(16)
+                data = sock.recv(amount_expected - amount_received)
+                if not data:
+                    break
+                chunks.append(data)
                 amount_received += len(data)
-                print(f"Received: {data.decode('utf-8')}")
+            print(f"Received: {b''.join(chunks).decode('utf-8', errors='replace')}")
         except socket.error as e:
+            PROBE_CACHE.invalidate(ip, port)
             print(f"Socket error during communication: {str(e)}")
         finally:
             print("Closing connection to the server")
             sock.close()
 
     except ConnectionRefusedError:
+        PROBE_CACHE.invalidate(ip, port)
         print(f"Connection to {ip}:{port} refused. Is the TCP server running?")
     except socket.timeout:
+        PROBE_CACHE.invalidate(ip, port)
         print(f"Connection to {ip}:{port} timed out.")
     except Exception as e:
         print(f"An error occurred: {str(e)}")
 
 
-def tcp_echo_server(ip, port, stop_event=None) -> None:
+def _recv_exactly(sock, size) -> bytes:
+    """Read exactly size bytes from a stream socket, or fewer on EOF."""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            break
+        received += n
+    return bytes(view[:received])
+
+
+def tcp_echo_session(ip, port, messages, window=SESSION_WINDOW) -> list:
+    """Pipeline many messages over one TCP connection and return the echoed replies.
+
+    Requires a server running in session mode. Up to `window` framed messages
+    are in flight at once. Replies are read while the requests are still
+    being written, so large messages cannot fill the socket buffers of both
+    sides and leave each one waiting for the other.
+    """
+    replies = []
+    try:
+        with connect_to(ip, port) as sock, selectors.DefaultSelector() as selector:
+            print(f"Opened session to {ip} port {port}")
+            sock.setblocking(False)
+            payloads = [message.encode("utf-8") for message in messages]
+            for start in range(0, len(payloads), window):
+                batch = payloads[start : start + window]
+                out = b"".join(SESSION_HEADER.pack(len(p)) + p for p in batch)
+                pending = memoryview(out)
+                received = bytearray()
+                selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                while len(received) < len(out):  # Echoes are as long as requests
+                    for _, mask in selector.select():
+                        if mask & selectors.EVENT_WRITE:
+                            pending = pending[sock.send(pending) :]
+                            if not pending:
+                                selector.modify(sock, selectors.EVENT_READ)
+                        if mask & selectors.EVENT_READ:
+                            data = sock.recv(65536)
+                            if not data:
+                                raise ConnectionError("Session closed by the server")
+                            received += data
+                selector.unregister(sock)
+                offset = 0
+                for sent in batch:
+                    (size,) = SESSION_HEADER.unpack_from(received, offset)
+                    offset += SESSION_HEADER.size
+                    reply = bytes(received[offset : offset + size])
+                    offset += size
+                    if reply != sent:
+                        raise ConnectionError("Echoed reply does not match request")
+                    replies.append(reply.decode("utf-8"))
+            print(f"Received {len(replies)} replies, closing session")
+    except ConnectionRefusedError:
+        print(f"Connection to {ip}:{port} refused. Is the TCP server running?")
+    except socket.timeout:
+        print(f"Connection to {ip}:{port} timed out.")
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+    return replies
+
+
+class ConnectionPool:
+    """Keeps warm TCP connections per (ip, port) so callers can reuse them.
+
+    At most `max_size` idle connections are kept per address, connections
+    idle for longer than `idle_timeout` seconds are closed, and every
+    connection is health checked before it is handed out again.
+    """
+
+    def __init__(self, max_size=8, idle_timeout=30.0, timeout=5.0) -> None:
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = {}  # (ip, port) -> deque of (sock, time returned)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_healthy(sock) -> bool:
+        """A kept-alive echo connection must have nothing to read and no EOF."""
+        try:
+            sock.setblocking(False)
+            sock.recv(1, socket.MSG_PEEK)  # Stray data or EOF
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def take(self, ip, port):
+        """Return a healthy idle connection, or None if a new one is needed."""
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.get((ip, port))
+            while idle:
+                sock, returned = idle.pop()  # Most recently used first
+                if now - returned < self.idle_timeout and self.is_healthy(sock):
+                    return sock
+                sock.close()
+        return None
+
+    def acquire(self, ip, port) -> socket.socket:
+        """Return a blocking connection, reusing an idle one when possible."""
+        sock = self.take(ip, port) or connect_to(ip, port, self.timeout)
+        sock.settimeout(self.timeout)
+        return sock
+
+    def release(self, ip, port, sock, healthy=True) -> None:
+        """Give a connection back, closing it if broken or the pool is full."""
+        with self.lock:
+            idle = self.idle.setdefault((ip, port), deque())
+            if healthy and len(idle) < self.max_size:
+                idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def evict_idle(self) -> None:
+        """Close every connection that has been idle for too long."""
+        now = time.monotonic()
+        with self.lock:
+            for idle in self.idle.values():
+                while idle and now - idle[0][1] >= self.idle_timeout:
+                    idle.popleft()[0].close()
+
+    def close(self) -> None:
+        with self.lock:
+            for idle in self.idle.values():
+                while idle:
+                    idle.pop()[0].close()
+            self.idle.clear()
+
+
+class EchoClient:
+    """TCP echo client reusing keep-alive connections from a ConnectionPool.
+
+    Connections stay open between calls, so the server must run in session
+    mode to benefit. A reused connection that turns out to be stale (for
+    instance closed by a one-shot server) is retried once on a fresh one.
+    """
+
+    def __init__(self, pool=None) -> None:
+        self.pool = pool or ConnectionPool()
+
+    def echo(self, ip, port, message) -> str:
+        payload = message.encode("utf-8")
+        for attempt in range(2):
+            sock = self.pool.take(ip, port) if attempt == 0 else None
+            reused = sock is not None
+            if sock is None:
+                sock = connect_to(ip, port, self.pool.timeout)
+            sock.settimeout(self.pool.timeout)
+            try:
+                sock.sendall(payload)
+                reply = _recv_exactly(sock, len(payload))
+                if len(reply) < len(payload):
+                    raise ConnectionError("Connection closed by the server")
+            except OSError:
+                self.pool.release(ip, port, sock, healthy=False)
+                if reused:
+                    continue
+                raise
+            self.pool.release(ip, port, sock)
+            return reply.decode("utf-8", errors="replace")
+
+    async def echo_async(self, ip, port, message) -> str:
+        loop = asyncio.get_running_loop()
+        payload = message.encode("utf-8")
+        for attempt in range(2):
+            sock = self.pool.take(ip, port) if attempt == 0 else None
+            reused = sock is not None
+            try:
+                if sock is None:
+                    sock = client_socket(ip)
+                    sock.setblocking(False)
+                    await asyncio.wait_for(
+                        loop.sock_connect(sock, socket_address(ip, port)),
+                        self.pool.timeout,
+                    )
+                sock.setblocking(False)
+                await loop.sock_sendall(sock, payload)
+                reply = bytearray(len(payload))
+                view = memoryview(reply)
+                received = 0
+                while received < len(payload):
+                    n = await asyncio.wait_for(
+                        loop.sock_recv_into(sock, view[received:]),
+                        self.pool.timeout,
+                    )
+                    if not n:
+                        raise ConnectionError("Connection closed by the server")
+                    received += n
+            except (OSError, asyncio.TimeoutError):
+                self.pool.release(ip, port, sock, healthy=False)
+                if reused:
+                    continue
+                raise
+            self.pool.release(ip, port, sock)
+            return reply.decode("utf-8", errors="replace")
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+def _echo_session(client, address, stop_event=None, server="tcp") -> None:
+    """Echo everything the client sends until it closes its side."""
+    total = 0
+    timeout = poll_timeout(stop_event)
+    with stop_selector(client, stop_event) as selector:
+        while stop_event is None or not stop_event.is_set():
+            # Sleep until the client sends something or the server is stopped
+            ready = selector.select(timeout)
+            if not any(key.fileobj is client for key, _ in ready):
+                continue
+            data = client.recv(65536)
+            if not data:
+                break
+            client.sendall(data)
+            total += len(data)
+            METRICS.inc_many(
+                {"bytes_received": len(data), "bytes_sent": len(data)}, server=server
+            )
+    if should_log():
+        packet_log.info("Session with %s ended after %d bytes", address, total)
+
+
+def _echo_session_thread(client, address, stop_event=None) -> None:
+    """Run one blocking-engine session on its own thread, then close the client."""
+    try:
+        _echo_session(client, address, stop_event)
+    except socket.timeout:
+        pass  # The client stopped reading its echoes
+    except Exception as e:
+        METRICS.inc("errors", server="tcp")
+        print(f"Error during communication: {str(e)}")
+    finally:
+        client.close()
+
+
+def _record_echo(server, size, started, received, sent) -> None:
+    """Count one echoed message and time its receive and send stages."""
+    METRICS.inc_many(
+        {"messages": 1, "bytes_received": size, "bytes_sent": size}, server=server
+    )
+    METRICS.observe("latency", received - started, server=server, stage="recv")
+    METRICS.observe("latency", sent - received, server=server, stage="send")
+
+
+def tcp_echo_server(ip, port, stop_event=None, session=False) -> None:
     """TCP Echo Server"""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.settimeout(1)  # Set a timeout of 1 second for non-blocking accept
-    server_address = (ip, port)
+    sock = server_socket(ip)
+    sock.setblocking(False)  # Accept only once the selector reports a client
+    server_address = socket_address(ip, port)
     print(f"Starting up TCP echo server on {ip} port {port}")
 
     try:
         sock.bind(server_address)
         sock.listen(5)
+        PORT_ALLOCATOR.release(port, "tcp")
+        selector = stop_selector(sock, stop_event)
+        timeout = poll_timeout(stop_event)
 
         while stop_event is None or not stop_event.is_set():
+            tracing = PROFILER.enabled  # Stage timestamps only while profiling
             try:
+                # Idle servers sleep here until a client connects or a stop
+                if not selector.select(timeout):
+                    continue
+                if tracing:
+                    waiting = time.perf_counter_ns()
                 client, address = sock.accept()  # Accept connections
+                accepted = time.perf_counter_ns()
+                if tracing:
+                    PROFILER.record("tcp", "accept", accepted - waiting)
+                METRICS.inc("connections", server="tcp")
+                if sock.family == socket.AF_UNIX:
+                    address = describe_peer(address, peer_credentials(client))
                 client.settimeout(1)  # Non-blocking client communication
+                if session:
+                    # Keep-alive clients get a thread each, so one cannot
+                    # hold up the accept loop for everyone else
+                    threading.Thread(
+                        target=_echo_session_thread,
+                        args=(client, address, stop_event),
+                        daemon=True,
+                    ).start()
+                    continue
                 try:
                     data = client.recv(2048)
                     if data:
-                        print(f"Data: {data.decode('utf-8')}")
+                        received = time.perf_counter_ns()
+                        logged = should_log()
+                        if logged:
+                            packet_log.info("Data: %s", data.decode("utf-8", "replace"))
+                        if tracing:
+                            handled = time.perf_counter_ns()
+                            PROFILER.record("tcp", "recv", received - accepted)
+                            PROFILER.record("tcp", "handle", handled - received)
                         client.sendall(data)
-                        print(f"Sent {len(data)} bytes back to {address}")
+                        sent = time.perf_counter_ns()
+                        if tracing:
+                            PROFILER.record("tcp", "send", sent - handled)
+                        if logged:
+                            packet_log.info(
+                                "Sent %d bytes back to %s", len(data), address
+                            )
+                        _record_echo("tcp", len(data), accepted, received, sent)
                 except socket.timeout:
                     continue  # Handle client timeout and keep waiting
                 except Exception as e:
+                    METRICS.inc("errors", server="tcp")
                     print(f"Error during communication: {str(e)}")
                 finally:
                     client.close()
-            except socket.timeout:
-                continue  # Continue loop if accept() times out
+            except BlockingIOError:
+                continue  # Woken by stop_event, no client is waiting
             except Exception as e:
                 print(f"Server error: {str(e)}")
+        selector.close()
     except OSError as e:
         print(f"Error: Unable to bind to {ip}:{port}. It may already be in use.")
     finally:
         sock.close()
+        remove_unix_socket(ip)
+        print("TCP server closed.")
+
+
+async def _handle_tcp_echo(reader, writer, session=False, tasks=None) -> None:
+    """Echo a single request, or a whole session, back to the client.
+
+    The handler's task is kept in `tasks` while it runs, so the server
+    can cancel the sessions still open when it stops.
+    """
+    task = asyncio.current_task()
+    if tasks is not None:
+        tasks.add(task)
+    address = writer.get_extra_info("peername")
+    credentials = peer_credentials(writer.get_extra_info("socket"))
+    if credentials is not None:
+        address = describe_peer(address, credentials)  # Unix socket peer
+    accepted = time.perf_counter_ns()
+    tracing = PROFILER.enabled
+    METRICS.inc("connections", server="tcp-async")
+    try:
+        if session:
+            total = 0
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+                total += len(data)
+                METRICS.inc_many(
+                    {"bytes_received": len(data), "bytes_sent": len(data)},
+                    server="tcp-async",
+                )
+            if should_log():
+                packet_log.info("Session with %s ended after %d bytes", address, total)
+            return
+        data = await reader.read(2048)
+        if data:
+            received = time.perf_counter_ns()
+            logged = should_log()
+            if logged:
+                packet_log.info("Data: %s", data.decode("utf-8", "replace"))
+            if tracing:
+                handled = time.perf_counter_ns()
+                PROFILER.record("tcp-async", "recv", received - accepted)
+                PROFILER.record("tcp-async", "handle", handled - received)
+            writer.write(data)
+            await writer.drain()
+            sent = time.perf_counter_ns()
+            if tracing:
+                PROFILER.record("tcp-async", "send", sent - handled)
+            if logged:
+                packet_log.info("Sent %d bytes back to %s", len(data), address)
+            _record_echo("tcp-async", len(data), accepted, received, sent)
+    except asyncio.CancelledError:
+        pass  # The server is stopping
+    except Exception as e:
+        METRICS.inc("errors", server="tcp-async")
+        print(f"Error during communication: {str(e)}")
+    finally:
+        writer.close()
+        if tasks is not None:
+            tasks.discard(task)
+
+
+async def _serve_tcp_echo(ip, port, stop_event=None, session=False) -> None:
+    tasks = set()  # Running handlers, cancelled on the way out
+    handler = functools.partial(_handle_tcp_echo, session=session, tasks=tasks)
+    if is_unix_address(ip):
+        remove_unix_socket(ip)
+        server = await asyncio.start_unix_server(handler, unix_path(ip), backlog=1024)
+    else:
+        server = await asyncio.start_server(
+            handler, ip, port, reuse_address=True, backlog=1024
+        )
+    PORT_ALLOCATOR.release(port, "tcp")
+    async with server:
+        try:
+            if stop_event is None:
+                await server.serve_forever()
+            elif hasattr(stop_event, "fileno"):
+                # The event loop's own selector wakes up on the stop descriptor
+                loop = asyncio.get_running_loop()
+                stopped = loop.create_future()
+                loop.add_reader(
+                    stop_event, lambda: stopped.done() or stopped.set_result(None)
+                )
+                try:
+                    await stopped
+                finally:
+                    loop.remove_reader(stop_event)
+            else:
+                # Park a worker thread on the event so the loop itself never polls
+                await asyncio.to_thread(stop_event.wait)
+        finally:
+            # Keep-alive sessions would otherwise be torn down mid-read
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def tcp_echo_server_async(ip, port, stop_event=None, session=False) -> None:
+    """TCP Echo Server running every connection on a single asyncio event loop"""
+    print(f"Starting up asyncio TCP echo server on {ip} port {port}")
+    try:
+        asyncio.run(_serve_tcp_echo(ip, port, stop_event, session))
+    except OSError:
+        print(f"Error: Unable to bind to {ip}:{port}. It may already be in use.")
+    finally:
+        remove_unix_socket(ip)
         print("TCP server closed.")
 
 
+# Interchangeable TCP server engines, all sharing the (ip, port, stop_event) contract
+TCP_SERVER_ENGINES = {
+    "blocking": tcp_echo_server,
+    "asyncio": tcp_echo_server_async,
+    "session": functools.partial(tcp_echo_server_async, session=True),
+}
+
+
+# Bulk transfers: a header with the payload size and flags, then the raw payload,
+# answered by an ack carrying what the server received and how long it took
+BULK_HEADER = struct.Struct("!QB")
+BULK_ACK = struct.Struct("!Qd")
+BULK_ECHO = 0x01  # Flag: send the payload back instead of sinking it
+BULK_CHUNK = 1024 * 1024
+BULK_SINKS = ("discard", "mmap")
+BULK_MAX_SIZE = 64 * 2**30  # Largest payload a server accepts by default
+
+
+def format_throughput(nbytes: int, seconds: float) -> str:
+    rate = nbytes / max(seconds, 1e-9)
+    return (
+        f"{nbytes / 2**20:.1f} MiB in {seconds:.3f}s "
+        f"({rate / 2**20:.1f} MiB/s, {rate * 8 / 1e9:.2f} Gbit/s)"
+    )
+
+
+def _send_generated(sock, size) -> int:
+    """Send `size` bytes of a repeating pattern with sendfile, like a file.
+
+    The pattern is written once to an anonymous memfd, or a temporary file
+    where there is none, and sent from there over and over.
+    """
+    pattern = bytes(range(256)) * (4 * BULK_CHUNK // 256)
+    if hasattr(os, "memfd_create"):
+        f = open(os.memfd_create("bulk-pattern", os.MFD_CLOEXEC), "w+b")
+    else:
+        f = tempfile.TemporaryFile()
+    with f:
+        f.write(pattern)
+        f.flush()
+        sent = 0
+        while sent < size:
+            n = sock.sendfile(f, 0, min(len(pattern), size - sent))
+            if not n:
+                break
+            sent += n
+    return sent
+
+
+def _drain(sock, size, result) -> None:
+    """Read and drop `size` echoed bytes, storing how many arrived in result."""
+    buffer = bytearray(BULK_CHUNK)
+    received = 0
+    while received < size:
+        n = sock.recv_into(buffer, min(len(buffer), size - received))
+        if not n:
+            break
+        received += n
+    result["echoed"] = received
+
+
+def tcp_bulk_client(ip, port, path=None, size=BULK_CHUNK, echo=False) -> dict:
+    """Stream a file, or `size` generated bytes, to a bulk server and report throughput.
+
+    Files and generated payloads go out with socket.sendfile, so the
+    payload never passes through user space buffers. With echo=True the server sends everything back and a second
+    thread drains it while the payload is still being sent.
+    """
+    if path is not None:
+        size = os.path.getsize(path)
+    result = {"sent": 0, "echoed": 0, "server_received": 0, "server_seconds": 0.0}
+    try:
+        with connect_to(ip, port) as sock:
+            sock.sendall(BULK_HEADER.pack(size, BULK_ECHO if echo else 0))
+            start = time.perf_counter()
+            drainer = None
+            if echo:
+                drainer = threading.Thread(target=_drain, args=(sock, size, result))
+                drainer.start()
+            if path is not None:
+                with open(path, "rb") as f:
+                    result["sent"] = sock.sendfile(f)
+            else:
+                result["sent"] = _send_generated(sock, size)
+            if drainer is not None:
+                drainer.join()
+            ack = _recv_exactly(sock, BULK_ACK.size)
+            result["seconds"] = time.perf_counter() - start
+            if len(ack) < BULK_ACK.size:
+                raise ConnectionError("Bulk transfer closed by the server")
+            result["server_received"], result["server_seconds"] = BULK_ACK.unpack(ack)
+        print(f"Sent {format_throughput(result['sent'], result['seconds'])}")
+        if echo:
+            print(f"Echoed {format_throughput(result['echoed'], result['seconds'])}")
+        print(
+            "Server received "
+            f"{format_throughput(result['server_received'], result['server_seconds'])}"
+        )
+    except ConnectionRefusedError:
+        print(f"Connection to {ip}:{port} refused. Is the bulk server running?")
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+    return result
+
+
+def _bulk_discard(client, size, stop_event=None) -> int:
+    buffer = bytearray(BULK_CHUNK)
+    received = 0
+    while received < size and (stop_event is None or not stop_event.is_set()):
+        n = client.recv_into(buffer, min(len(buffer), size - received))
+        if not n:
+            break
+        received += n
+    return received
+
+
+def _bulk_echo(client, size, stop_event=None) -> int:
+    buffer = bytearray(BULK_CHUNK)
+    view = memoryview(buffer)
+    received = 0
+    while received < size and (stop_event is None or not stop_event.is_set()):
+        n = client.recv_into(buffer, min(len(buffer), size - received))
+        if not n:
+            break
+        client.sendall(view[:n])
+        received += n
+    return received
+
+
+def _bulk_mmap(client, size, f, stop_event=None) -> int:
+    """Receive straight into the pages of `f`, memory-mapped at `size` bytes."""
+    received = 0
+    with f:
+        f.truncate(size)
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), size) as mapped:
+            with memoryview(mapped) as view:
+                while received < size and (
+                    stop_event is None or not stop_event.is_set()
+                ):
+                    with view[received : received + BULK_CHUNK] as chunk:
+                        n = client.recv_into(chunk)
+                    if not n:
+                        break
+                    received += n
+    return received
+
+
+def _bulk_session(
+    client, address, sink, output, stop_event=None, max_size=BULK_MAX_SIZE
+) -> None:
+    """Receive one bulk transfer, sink or echo it, then acknowledge it."""
+    try:
+        header = _recv_exactly(client, BULK_HEADER.size)
+        if len(header) < BULK_HEADER.size:
+            return
+        size, flags = BULK_HEADER.unpack(header)
+        if size > max_size:
+            METRICS.inc("errors", server="bulk")
+            print(f"Rejected bulk transfer of {size} bytes from {address}")
+            client.sendall(BULK_ACK.pack(0, 0.0))
+            return
+        start = time.perf_counter()
+        if flags & BULK_ECHO:
+            received = _bulk_echo(client, size, stop_event)
+        elif sink == "mmap":
+            # A fresh file every time, never one planted at a predictable path
+            fd, path = tempfile.mkstemp(
+                ".bin", f"bulk-{address[0]}-{address[1]}-", output
+            )
+            received = _bulk_mmap(client, size, os.fdopen(fd, "w+b"), stop_event)
+            print(f"Stored bulk transfer from {address} in {path}")
+        else:
+            received = _bulk_discard(client, size, stop_event)
+        seconds = time.perf_counter() - start
+        client.sendall(BULK_ACK.pack(received, seconds))
+        sent = received if flags & BULK_ECHO else 0
+        METRICS.inc_many(
+            {"messages": 1, "bytes_received": received, "bytes_sent": sent},
+            server="bulk",
+        )
+        print(f"Bulk transfer from {address}: {format_throughput(received, seconds)}")
+    except (OSError, OverflowError, ValueError) as e:
+        METRICS.inc("errors", server="bulk")
+        print(f"Error during bulk transfer: {str(e)}")
+    finally:
+        client.close()
+
+
+def tcp_bulk_server(
+    ip,
+    port,
+    stop_event=None,
+    sink="discard",
+    output=None,
+    max_size=BULK_MAX_SIZE,
+) -> None:
+    """TCP Bulk Server: sinks or echoes large payloads, one thread per transfer.
+
+    Payloads are read with recv_into into preallocated buffers, and with
+    sink="mmap" straight into a memory-mapped file per transfer in
+    `output` (the temporary directory by default). Transfers announcing
+    more than `max_size` bytes are turned away.
+    """
+    if sink not in BULK_SINKS:
+        raise ValueError(f"Unknown bulk sink: {sink}")
+    output = output or tempfile.gettempdir()
+    sock = server_socket(ip)
+    sock.setblocking(False)
+    print(f"Starting up TCP bulk server on {ip} port {port} ({sink})")
+
+    try:
+        sock.bind(socket_address(ip, port))
+        sock.listen(16)
+        PORT_ALLOCATOR.release(port, "tcp")
+        timeout = poll_timeout(stop_event)
+        with stop_selector(sock, stop_event) as selector:
+            while stop_event is None or not stop_event.is_set():
+                if not selector.select(timeout):
+                    continue
+                try:
+                    client, address = sock.accept()
+                except BlockingIOError:
+                    continue  # Woken by stop_event
+                client.setblocking(True)
+                if sock.family == socket.AF_UNIX:
+                    # Unix peers have no address, name them by pid and uid
+                    credentials = peer_credentials(client)
+                    if credentials is not None:
+                        pid, uid, _ = credentials
+                        address = (f"pid{pid}", f"uid{uid}")
+                    else:
+                        address = ("unix", f"fd{client.fileno()}")
+                METRICS.inc("connections", server="bulk")
+                threading.Thread(
+                    target=_bulk_session,
+                    args=(client, address, sink, output, stop_event, max_size),
+                    daemon=True,
+                ).start()
+    except OSError:
+        print(f"Error: Unable to bind to {ip}:{port}. It may already be in use.")
+    finally:
+        sock.close()
+        remove_unix_socket(ip)
+        print("TCP bulk server closed.")
+
+
+SHM_METRICS_BATCH = 1024  # Messages counted locally before updating METRICS
+
+
+def _shm_echo_session(channel, stop_event=None) -> None:
+    """Echo messages on a shared memory channel until the client leaves."""
+    if hasattr(stop_event, "fileno"):
+        channel.selector.register(stop_event, selectors.EVENT_READ)
+    messages = size = 0
+    try:
+        while stop_event is None or not stop_event.is_set():
+            tracing = PROFILER.enabled  # Stage timestamps only while profiling
+            if tracing:
+                waiting = time.perf_counter_ns()
+            payload = channel.recv()
+            if payload is None:
+                break
+            if tracing:
+                received = time.perf_counter_ns()
+                PROFILER.record("shm", "recv", received - waiting)
+            channel.send(payload)
+            if tracing:
+                PROFILER.record("shm", "send", time.perf_counter_ns() - received)
+            messages += 1
+            size += len(payload)
+            if messages == SHM_METRICS_BATCH:
+                counts = {"messages": messages, "bytes_received": size}
+                METRICS.inc_many({**counts, "bytes_sent": size}, server="shm")
+                messages = size = 0
+    except ConnectionError:
+        pass  # Left or stopped while its replies were piling up
+    finally:
+        counts = {"messages": messages, "bytes_received": size}
+        METRICS.inc_many({**counts, "bytes_sent": size}, server="shm")
+        channel.close()
+
+
+def shm_echo_server(ip, port, stop_event=None, capacity=SHM_CAPACITY) -> None:
+    """Shared Memory Echo Server for clients on the same host.
+
+    Clients meet the server on the Unix socket shm_address(ip, port), then
+    exchange messages through a pair of ring buffers in shared memory, one
+    thread per client. Like udp_echo_server_fast it skips per-message logging.
+    """
+    address = shm_address(ip, port)
+    sock = server_socket(address)
+    sock.setblocking(False)
+    print(f"Starting up shared memory echo server on {address}")
+
+    try:
+        sock.bind(socket_address(address, port))
+        sock.listen(16)
+        timeout = poll_timeout(stop_event)
+        with stop_selector(sock, stop_event) as selector:
+            while stop_event is None or not stop_event.is_set():
+                if not selector.select(timeout):
+                    continue
+                try:
+                    control, _ = sock.accept()
+                except BlockingIOError:
+                    continue  # Woken by stop_event
+                control.setblocking(True)
+                try:
+                    channel = ShmChannel.accept(control, capacity)
+                except OSError as e:
+                    control.close()
+                    METRICS.inc("errors", server="shm")
+                    print(f"Error setting up shared memory: {str(e)}")
+                    continue
+                METRICS.inc("connections", server="shm")
+                if should_log():
+                    peer = describe_peer(address, peer_credentials(control))
+                    packet_log.info("Shared memory session with %s", peer)
+                threading.Thread(
+                    target=_shm_echo_session, args=(channel, stop_event), daemon=True
+                ).start()
+    except OSError:
+        print(f"Error: Unable to bind to {address}. It may already be in use.")
+    finally:
+        sock.close()
+        remove_unix_socket(address)
+        print("Shared memory server closed.")
+
+
+def shm_echo_client(ip, port, message):  # -> Any:
+    """Shared Memory Echo Client, the server must run on the same host"""
+    try:
+        channel = ShmChannel.connect(ip, port)
+    except (ConnectionRefusedError, FileNotFoundError):
+        print(f"Error: No shared memory echo server is running on {ip}:{port}.")
+        return
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        return
+
+    try:
+        print(f"Sending: {message}")
+        started = time.perf_counter_ns()
+        reply = channel.request(message.encode("utf-8"))
+        elapsed = (time.perf_counter_ns() - started) / 1000
+        print(f"Received: {reply.decode('utf-8', errors='replace')}")
+        print(f"Round trip: {elapsed:.1f} us")
+    except (OSError, ValueError) as e:
+        print(f"Error during communication: {str(e)}")
+    finally:
+        print("Closing connection to the server")
+        channel.close()
+
+
 def udp_echo_client(ip, port, message):  # -> Any:
     """UDP Echo Client with protocol mismatch detection"""
 
-    udp_open = scan_udp_port(ip, port)  # Scan for UDP server
-    tcp_open = scan_tcp_port(ip, port)  # Scan for TCP server
+    tcp_open, udp_open = detect_protocols(ip, port)  # Cached, probed in parallel
 
     if not udp_open and tcp_open:
         print(
@@ -102,10 +878,10 @@ def udp_echo_client(ip, port, message):  # -> Any:
         return
 
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock = client_socket(ip, socket.SOCK_DGRAM)
         sock.settimeout(5)  # Set a timeout of 5 seconds (adjustable)
 
-        server_address = (ip, port)
+        server_address = socket_address(ip, port)
         print(f"Sending to {ip} port {port}: {message}")
 
         try:
@@ -113,8 +889,10 @@ def udp_echo_client(ip, port, message):  # -> Any:
             data, server = sock.recvfrom(2048)  # Waiting for the echo response
             print(f"Received: {data.decode('utf-8')}")
         except socket.timeout:
+            PROBE_CACHE.invalidate(ip, port)
             print(f"UDP connection timed out. No response from {ip}:{port}.")
         except socket.error as e:
+            PROBE_CACHE.invalidate(ip, port)
             if e.errno == 10054:  # Handle connection reset by peer (WinError)
                 print(
                     f"UDP connection failed. The server might not be running, or a protocol mismatch occurred."
@@ -133,37 +911,231 @@ def udp_echo_client(ip, port, message):  # -> Any:
         print(f"An error occurred: {str(e)}")
 
 
+UDP_MAX_DATAGRAM = 65535
+PING = b"ping"
+PONG = b"pong"
+
+
 def udp_echo_server(ip, port, stop_event=None) -> None:
     """UDP Echo Server"""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_address = (ip, port)
+    sock = server_socket(ip, socket.SOCK_DGRAM)
+    server_address = socket_address(ip, port)
     print(f"Starting up UDP echo server on {ip} port {port}")
 
     try:
         sock.bind(server_address)
+        PORT_ALLOCATOR.release(port, "udp")
+        sock.setblocking(False)  # Drain queued datagrams, then wait on the selector
+        selector = stop_selector(sock, stop_event)
+        timeout = poll_timeout(stop_event)
+        buffer = bytearray(UDP_MAX_DATAGRAM)
+        view = memoryview(buffer)
+        # Unix datagrams carry the sender's pid and uid as SCM_CREDENTIALS
+        credentials = sock.family == socket.AF_UNIX and hasattr(
+            socket, "SCM_CREDENTIALS"
+        )
+        sender = None
 
         while stop_event is None or not stop_event.is_set():
+            tracing = PROFILER.enabled  # Stage timestamps only while profiling
             try:
-                sock.settimeout(1)
-                data, address = sock.recvfrom(2048)
-                print(f"Received {len(data)} bytes from {address}")
-                message = data.decode("utf-8")
-                print(f"Data: {message}")
+                if tracing:
+                    waiting = time.perf_counter_ns()
+                if credentials:
+                    n, address, sender = recv_credentials_into(sock, buffer)
+                else:
+                    n, address = sock.recvfrom_into(buffer)
+                received = time.perf_counter_ns()
+                data = view[:n]
+                logged = should_log()
+                if logged:
+                    peer = describe_peer(address, sender)
+                    packet_log.info("Received %d bytes from %s", n, peer)
+                    packet_log.info("Data: %s", str(data, "utf-8", errors="replace"))
 
                 # Respond to "ping" messages to help with UDP detection
-                if message == "ping":
-                    response = "pong"
-                else:
-                    response = message  # Echo back the received message
+                response = PONG if data == PING else data
 
-                sent = sock.sendto(response.encode("utf-8"), address)
-                print(f"Sent {sent} bytes back to {address}")
-            except socket.timeout:
-                continue
+                if tracing:
+                    handled = time.perf_counter_ns()
+                    PROFILER.record("udp", "recv", received - waiting)
+                    PROFILER.record("udp", "handle", handled - received)
+                sent = sock.sendto(response, address)
+                if tracing:
+                    PROFILER.record("udp", "send", time.perf_counter_ns() - handled)
+                if logged:
+                    packet_log.info("Sent %d bytes back to %s", sent, peer)
+                METRICS.inc_many(
+                    {"messages": 1, "bytes_received": n, "bytes_sent": sent},
+                    server="udp",
+                )
+                elapsed = time.perf_counter_ns() - received
+                METRICS.observe("latency", elapsed, server="udp", stage="send")
+            except BlockingIOError:
+                selector.select(timeout)  # Nothing queued, sleep until more or a stop
             except Exception as e:
+                METRICS.inc("errors", server="udp")
                 print(f"Error during communication: {str(e)}")
+        selector.close()
     except OSError as e:
         print(f"Error: Unable to bind to {ip}:{port}. It may already be in use.")
     finally:
         sock.close()
+        remove_unix_socket(ip)
+        print("UDP server closed.")
+
+
+UDP_METRICS_BATCH = 1024  # Datagrams counted locally before updating METRICS
+
+
+def _udp_echo_loop(sock, stop_event=None) -> None:
+    """Echo datagrams straight out of one preallocated buffer, without logging.
+
+    Counts are kept in locals and added to METRICS once per batch, or
+    whenever the socket goes idle, so the registry lock stays off the hot path.
+    """
+    buffer = bytearray(UDP_MAX_DATAGRAM)
+    view = memoryview(buffer)
+    recvfrom_into = sock.recvfrom_into
+    sendto = sock.sendto
+    selector = stop_selector(sock, stop_event)
+    timeout = poll_timeout(stop_event)
+    messages = total = errors = 0
+    while stop_event is None or not stop_event.is_set():
+        idle = False
+        try:
+            n, address = recvfrom_into(buffer)
+            if n == 4 and view[:4] == PING:
+                sendto(PONG, address)
+            else:
+                sendto(view[:n], address)
+            messages += 1
+            total += n
+            if messages < UDP_METRICS_BATCH:
+                continue
+        except BlockingIOError:
+            idle = True
+        except OSError:
+            errors += 1  # E.g. a reset from an earlier peer, keep serving
+        if messages or errors:
+            METRICS.inc_many(
+                {
+                    "messages": messages,
+                    "bytes_received": total,
+                    "bytes_sent": total,
+                    "errors": errors,
+                },
+                server="udp-fast",
+            )
+            messages = total = errors = 0
+        if idle:
+            selector.select(timeout)  # Drained, sleep until more or a stop
+    selector.close()
+
+
+def _udp_receiver(ip, port, reuse_port) -> socket.socket:
+    sock = server_socket(ip, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Room for bursts while the receiver is busy sending
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    try:
+        sock.bind(socket_address(ip, port))
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+def _exit_on_eof(fd) -> None:
+    os.read(fd, 1)
+    os._exit(0)
+
+
+def _fork_udp_receiver(sock, lifeline, lifeline_w) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        os.close(lifeline_w)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent shuts us down
+        threading.Thread(target=_exit_on_eof, args=(lifeline,), daemon=True).start()
+        _udp_echo_loop(sock)
+    finally:
+        os._exit(0)
+
+
+def udp_echo_server_fast(
+    ip, port, stop_event=None, receivers=1, processes=False
+) -> None:
+    """Binary-safe UDP Echo Server for high packet rates.
+
+    Works on raw bytes up to 64 KB in a preallocated buffer and skips
+    per-packet logging. With receivers > 1 every receiver binds its own
+    socket through SO_REUSEPORT, so the kernel spreads datagrams across
+    them; receivers run as threads, or as processes to use several cores.
+    Unix sockets have no SO_REUSEPORT, there all receivers share one socket.
+    """
+    print(f"Starting up fast UDP echo server on {ip} port {port}")
+    reuse_port = receivers > 1
+    socks = []
+    try:
+        if is_unix_address(ip):
+            socks = [_udp_receiver(ip, port, False)] * receivers
+        else:
+            for _ in range(receivers):
+                socks.append(_udp_receiver(ip, port, reuse_port))
+    except OSError:
+        # Release the port held by the receivers bound so far
+        for sock in socks:
+            sock.close()
+        print(f"Error: Unable to bind to {ip}:{port}. It may already be in use.")
+        return
+    PORT_ALLOCATOR.release(port, "udp")
+
+    try:
+        if processes:
+            # Children exit on EOF of this pipe, i.e. as soon as we are gone
+            lifeline, lifeline_w = os.pipe()
+            pids = [_fork_udp_receiver(sock, lifeline, lifeline_w) for sock in socks]
+            os.close(lifeline)
+            try:
+                if stop_event is None:
+                    for pid in pids:
+                        os.waitpid(pid, 0)
+                else:
+                    stop_event.wait()
+            finally:
+                for pid in pids:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                        os.waitpid(pid, 0)
+                    except (ProcessLookupError, ChildProcessError):
+                        pass
+                os.close(lifeline_w)
+        else:
+            threads = [
+                threading.Thread(target=_udp_echo_loop, args=(sock, stop_event))
+                for sock in socks[1:]
+            ]
+            for thread in threads:
+                thread.start()
+            _udp_echo_loop(socks[0], stop_event)
+            for thread in threads:
+                thread.join()
+    finally:
+        for sock in socks:
+            sock.close()
+        remove_unix_socket(ip)
         print("UDP server closed.")
+
+
+# Interchangeable UDP server engines, all sharing the (ip, port, stop_event) contract
+UDP_SERVER_ENGINES = {
+    "blocking": udp_echo_server,
+    "fast": udp_echo_server_fast,
+    "fast-multicore": functools.partial(
+        udp_echo_server_fast, receivers=os.cpu_count() or 1, processes=True
+    ),
+}
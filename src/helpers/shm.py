@@ -0,0 +1,326 @@
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+
+from helpers.transport import *
+
+# A shared memory channel holds one ring per direction. Each ring starts with
+# its head (consumer position), tail (producer position), the flag of a
+# consumer waiting for data and that of a producer waiting for space, on
+# separate cache lines, followed by `capacity` bytes of length-prefixed
+# messages. Positions only grow, the offset into the ring is pos % capacity.
+SHM_CAPACITY = 1 << 20  # Bytes per direction, a power of two
+SHM_HEAD, SHM_TAIL, SHM_WAITING, SHM_FULL, SHM_DATA = 0, 64, 128, 192, 256
+SHM_POSITION = struct.Struct("Q")
+SHM_LENGTH = struct.Struct("I")
+SHM_HELLO = struct.Struct("!I")  # Ring capacity, followed by the segment name
+DOORBELL = (1).to_bytes(8, "little")  # eventfd counters take 8 byte writes
+
+# Spin-then-block: a consumer polls its ring for up to its spin budget before
+# sleeping on the doorbell. The budget doubles whenever spinning paid off and
+# halves whenever the consumer had to sleep. Spinning cannot help on a single
+# CPU, where the producer only runs once the consumer gives the core up.
+SHM_SPIN_NS = 50_000 if (os.cpu_count() or 1) > 1 else 0
+SHM_SPIN_MAX_NS = 200_000
+
+
+def shm_address(ip, port) -> str:
+    """Return the Unix socket where a shared memory server meets its clients.
+
+    Shared memory only works between processes on one host, so any IP
+    selects the abstract socket for `port`; unix: addresses are used as is.
+    """
+    return ip if is_unix_address(ip) else f"{UNIX_PREFIX}@netprog-shm-{port}"
+
+
+class Doorbell:
+    """Wakes a consumer sleeping in select(), through an eventfd or a pipe."""
+
+    def __init__(self, fds=None) -> None:
+        if fds is None:
+            if hasattr(os, "eventfd"):
+                fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+                fds = (fd, os.dup(fd))
+            else:
+                fds = os.pipe()
+                for fd in fds:
+                    os.set_blocking(fd, False)
+        self.read_fd, self.write_fd = fds
+
+    def fileno(self) -> int:
+        return self.read_fd
+
+    def ring(self) -> None:
+        try:
+            os.write(self.write_fd, DOORBELL)
+        except BlockingIOError:
+            pass  # Already rung and not yet cleared
+
+    def clear(self) -> None:
+        try:
+            os.read(self.read_fd, 4096)
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class ShmRing:
+    """A lock-free single-producer/single-consumer ring in shared memory.
+
+    The producer writes a message, then publishes the new tail; the consumer
+    reads it, then publishes the new head. Each side caches its own position
+    and only reads the other one. This relies on stores becoming visible in
+    program order, which x86-64 guarantees.
+
+    A side about to sleep raises its flag, then checks the ring once more;
+    the other side publishes its position, then checks the flag and rings
+    `doorbell` (data) or `space` (room freed). Both need a full barrier
+    between the store and the load, or each may miss the other's store.
+    Taking an uncontended lock is a locked instruction, which is one.
+    """
+
+    def __init__(
+        self, buf: memoryview, capacity: int, doorbell: Doorbell, space: Doorbell
+    ) -> None:
+        self.buf = buf
+        self.data = buf[SHM_DATA : SHM_DATA + capacity]
+        self.capacity = capacity
+        self.doorbell = doorbell
+        self.space = space
+        self.head = SHM_POSITION.unpack_from(buf, SHM_HEAD)[0]
+        self.tail = SHM_POSITION.unpack_from(buf, SHM_TAIL)[0]
+        self.spin_ns = SHM_SPIN_NS
+        self.barrier = threading.Lock()
+
+    def fence(self) -> None:
+        with self.barrier:
+            pass
+
+    @staticmethod
+    def size(capacity: int) -> int:
+        return SHM_DATA + capacity
+
+    def _write(self, pos: int, data) -> None:
+        start = pos % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.data[start : start + first] = data[:first]
+        if first < len(data):
+            self.data[: len(data) - first] = data[first:]
+
+    def _read(self, pos: int, size: int) -> bytes:
+        start = pos % self.capacity
+        if start + size <= self.capacity:
+            return bytes(self.data[start : start + size])
+        first = self.capacity - start
+        return bytes(self.data[start:]) + bytes(self.data[: size - first])
+
+    def fits(self, size: int) -> bool:
+        """Whether a message of `size` bytes fits in the free space right now."""
+        limit = self.tail + SHM_LENGTH.size + size - self.capacity
+        return SHM_POSITION.unpack_from(self.buf, SHM_HEAD)[0] >= limit
+
+    def put(self, payload, wait_for_space) -> None:
+        """Append one message, calling wait_for_space(size) while the ring is full."""
+        need = SHM_LENGTH.size + len(payload)
+        if need > self.capacity:
+            raise ValueError(f"Message of {len(payload)} bytes exceeds the ring")
+        if not self.fits(len(payload)):
+            wait_for_space(len(payload))
+        self._write(self.tail, SHM_LENGTH.pack(len(payload)))
+        self._write(self.tail + SHM_LENGTH.size, payload)
+        self.tail += need
+        SHM_POSITION.pack_into(self.buf, SHM_TAIL, self.tail)
+        self.fence()
+        if SHM_POSITION.unpack_from(self.buf, SHM_WAITING)[0]:
+            self.doorbell.ring()
+
+    def ready(self) -> bool:
+        return SHM_POSITION.unpack_from(self.buf, SHM_TAIL)[0] != self.head
+
+    def wait(self, selector: selectors.BaseSelector) -> bool:
+        """Spin, then sleep until a message arrives. False if anything else woke us.
+
+        `selector` watches the doorbell plus any descriptor that should end
+        the wait, such as the peer's control socket or a StopEvent.
+        """
+        if self.spin_ns:
+            deadline = time.perf_counter_ns() + self.spin_ns
+            while time.perf_counter_ns() < deadline:
+                if self.ready():
+                    self.spin_ns = min(self.spin_ns * 2, SHM_SPIN_MAX_NS)
+                    return True
+        SHM_POSITION.pack_into(self.buf, SHM_WAITING, 1)
+        self.fence()
+        try:
+            while not self.ready():
+                for key, _ in selector.select():
+                    if key.fileobj is not self.doorbell:
+                        return self.ready()
+                    self.doorbell.clear()
+        finally:
+            SHM_POSITION.pack_into(self.buf, SHM_WAITING, 0)
+        if self.spin_ns:
+            self.spin_ns = max(self.spin_ns // 2, 1_000)
+        return True
+
+    def get(self) -> bytes:
+        """Take the next message, the ring must be ready()."""
+        (size,) = SHM_LENGTH.unpack(self._read(self.head, SHM_LENGTH.size))
+        payload = self._read(self.head + SHM_LENGTH.size, size)
+        self.head += SHM_LENGTH.size + size
+        SHM_POSITION.pack_into(self.buf, SHM_HEAD, self.head)
+        self.fence()
+        if SHM_POSITION.unpack_from(self.buf, SHM_FULL)[0]:
+            self.space.ring()
+        return payload
+
+    def release(self) -> None:
+        """Drop the views into the segment so it can be closed."""
+        self.data.release()
+        self.buf.release()
+
+
+class ShmChannel:
+    """A bidirectional message channel over two ShmRings in one segment.
+
+    A server accepts clients on a Unix socket and hands each one a fresh
+    segment and both doorbells (SCM_RIGHTS). The socket then stays open only
+    so either side notices when the other one goes away.
+
+    Each side sleeps on one doorbell, rung for new data in its inbox and
+    for space freed in its outbox. A client waiting for space keeps taking
+    replies off its inbox, so pipelining more than a ring's worth of
+    requests cannot leave both sides waiting on a full ring.
+    """
+
+    def __init__(self, shm, control, doorbells, capacity, server) -> None:
+        self.shm = shm
+        self.control = control
+        self.doorbells = doorbells
+        self.server = server
+        self.pending = deque()  # Replies taken off the inbox during send()
+        size = ShmRing.size(capacity)
+        rings = [
+            ShmRing(
+                shm.buf[i * size : (i + 1) * size],
+                capacity,
+                doorbells[i],
+                doorbells[1 - i],
+            )
+            for i in range(2)
+        ]
+        # Ring 0 carries requests to the server, ring 1 replies to the client
+        self.inbox, self.outbox = rings if server else rings[::-1]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.inbox.doorbell, selectors.EVENT_READ)
+        self.selector.register(control, selectors.EVENT_READ)
+
+    @classmethod
+    def accept(cls, control, capacity=SHM_CAPACITY) -> "ShmChannel":
+        """Set up a channel for a client that connected to `control`."""
+        control.settimeout(5)  # A stalled client must not hold up the server
+        doorbells = [Doorbell(), Doorbell()]
+        shm = shared_memory.SharedMemory(create=True, size=2 * ShmRing.size(capacity))
+        try:
+            fds = [fd for d in doorbells for fd in (d.read_fd, d.write_fd)]
+            socket.send_fds(
+                control, [SHM_HELLO.pack(capacity) + shm.name.encode()], fds
+            )
+            # Once the client has mapped the segment its name is no longer needed
+            if not control.recv(1):
+                raise ConnectionError("Client left before mapping the segment")
+        except OSError:
+            shm.close()
+            shm.unlink()
+            for doorbell in doorbells:
+                doorbell.close()
+            raise
+        shm.unlink()
+        control.settimeout(None)
+        return cls(shm, control, doorbells, capacity, server=True)
+
+    @classmethod
+    def connect(cls, ip, port, timeout=5.0) -> "ShmChannel":
+        """Connect to the shared memory server at shm_address(ip, port)."""
+        control = connect_to(shm_address(ip, port), 0, timeout)
+        try:
+            hello, fds, _, _ = socket.recv_fds(control, 256, 4)
+            if len(fds) < 4:
+                raise ConnectionError("Server did not pass the shared memory setup")
+            (capacity,) = SHM_HELLO.unpack_from(hello)
+            shm = shared_memory.SharedMemory(hello[SHM_HELLO.size :].decode())
+            # The server owns and unlinks the segment, so keep our resource
+            # tracker from unlinking it again at exit, unless the server runs
+            # in this process and already shares the tracker's entry
+            server_pid = (peer_credentials(control) or (None,))[0]
+            if server_pid != os.getpid():
+                resource_tracker.unregister(shm._name, "shared_memory")
+            control.sendall(b"\1")
+            control.settimeout(None)
+        except OSError:
+            control.close()
+            raise
+        doorbells = [Doorbell(fds[0:2]), Doorbell(fds[2:4])]
+        return cls(shm, control, doorbells, capacity, server=False)
+
+    def send(self, payload) -> None:
+        self.outbox.put(payload, self.wait_for_space)
+
+    def wait_for_space(self, size: int) -> None:
+        """Sleep until the outbox has room for `size` bytes.
+
+        Raises ConnectionError if anything else in the selector fires, i.e.
+        the peer went away or the StopEvent was set.
+        """
+        outbox, inbox = self.outbox, self.inbox
+        SHM_POSITION.pack_into(outbox.buf, SHM_FULL, 1)
+        if not self.server:
+            SHM_POSITION.pack_into(inbox.buf, SHM_WAITING, 1)
+        outbox.fence()
+        try:
+            while not outbox.fits(size):
+                if not self.server and inbox.ready():
+                    while inbox.ready():
+                        self.pending.append(inbox.get())
+                    continue
+                for key, _ in self.selector.select():
+                    if key.fileobj is not inbox.doorbell:
+                        raise ConnectionError("Shared memory peer went away")
+                    inbox.doorbell.clear()
+        finally:
+            SHM_POSITION.pack_into(outbox.buf, SHM_FULL, 0)
+            if not self.server:
+                SHM_POSITION.pack_into(inbox.buf, SHM_WAITING, 0)
+
+    def recv(self):
+        """Return the next message, or None once the peer has gone away."""
+        if self.pending:
+            return self.pending.popleft()
+        if not self.inbox.ready() and not self.inbox.wait(self.selector):
+            return None
+        return self.inbox.get()
+
+    def request(self, payload) -> bytes:
+        """Send one message and wait for the reply."""
+        self.send(payload)
+        reply = self.recv()
+        if reply is None:
+            raise ConnectionError("Shared memory channel closed by the server")
+        return reply
+
+    def close(self) -> None:
+        self.selector.close()
+        self.control.close()
+        self.inbox.release()
+        self.outbox.release()
+        self.shm.close()
+        for doorbell in self.doorbells:
+            doorbell.close()
@@ -0,0 +1,118 @@
+import math
+
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS  # Slots per level
+WHEEL_LEVELS = 4  # 64**4 ticks, about 19 days at 0.1 s per tick
+TIMER_RESOLUTION = 0.1  # Seconds per tick
+
+
+class Timer:
+    """A callback scheduled on a TimerWheel, see TimerWheel.schedule()."""
+
+    __slots__ = ("tick", "callback", "args", "slot")
+
+    def __init__(self, tick: int, callback, args: tuple) -> None:
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.slot = None  # The set holding the timer while it is pending
+
+    @property
+    def pending(self) -> bool:
+        return self.slot is not None
+
+
+class TimerWheel:
+    """A hierarchical timing wheel: O(1) schedule and cancel for any number of timers.
+
+    Level 0 has one slot per tick, every slot of level n covers a whole
+    turn of level n - 1. Timers far away sit in a coarse slot and move down
+    a level each time the wheel below completes a turn, until they land in
+    their exact tick. Deadlines are rounded up to the next tick, so timers
+    may fire up to one resolution late but never early.
+    """
+
+    def __init__(self, resolution=TIMER_RESOLUTION, now=0.0) -> None:
+        self.resolution = resolution
+        self.current = self._tick(now)
+        self.levels = [[set() for _ in range(WHEEL_SLOTS)] for _ in range(WHEEL_LEVELS)]
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _tick(self, when: float) -> int:
+        return math.ceil(when / self.resolution)
+
+    def _insert(self, timer: Timer, earliest: int) -> None:
+        tick = max(timer.tick, earliest)
+        if tick - self.current >= WHEEL_SLOTS**WHEEL_LEVELS:
+            # Beyond the wheel: park in the farthest slot, then cascade again
+            tick = self.current + WHEEL_SLOTS**WHEEL_LEVELS - 1
+        level = 0
+        while tick - self.current >= WHEEL_SLOTS ** (level + 1):
+            level += 1
+        timer.slot = self.levels[level][(tick >> (WHEEL_BITS * level)) % WHEEL_SLOTS]
+        timer.slot.add(timer)
+
+    def schedule(self, deadline: float, callback, *args) -> Timer:
+        """Call callback(*args) from advance() once `deadline` has passed."""
+        timer = Timer(self._tick(deadline), callback, args)
+        self._insert(timer, self.current + 1)  # The current tick already fired
+        self.count += 1
+        return timer
+
+    def cancel(self, timer: Timer | None) -> None:
+        if timer is not None and timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def _cascade(self) -> None:
+        """Move the timers of every coarse slot just reached one level down."""
+        for level in range(1, WHEEL_LEVELS):
+            index = (self.current >> (WHEEL_BITS * level)) % WHEEL_SLOTS
+            slot = self.levels[level][index]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer, self.current)
+            if index:
+                break
+
+    def advance(self, now: float) -> int:
+        """Fire every timer due by `now` and return how many fired.
+
+        Callbacks may schedule or cancel timers, including their own.
+        """
+        target = math.floor(now / self.resolution)
+        fired = 0
+        while self.current < target:
+            if not self.count:
+                self.current = target  # Nothing pending, skip the empty ticks
+                break
+            self.current += 1
+            if self.current % WHEEL_SLOTS == 0:
+                self._cascade()
+            slot = self.levels[0][self.current % WHEEL_SLOTS]
+            while slot:
+                timer = slot.pop()
+                timer.slot = None
+                self.count -= 1
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
+
+    def timeout(self, now: float):
+        """Seconds until advance() has work to do, None without timers.
+
+        Suited as a select() timeout; past level 0 this is the time until
+        the next cascade, which may end up firing nothing.
+        """
+        if not self.count:
+            return None
+        level0 = self.levels[0]
+        for ahead in range(1, WHEEL_SLOTS - self.current % WHEEL_SLOTS + 1):
+            if level0[(self.current + ahead) % WHEEL_SLOTS]:
+                break
+        return max((self.current + ahead) * self.resolution - now, 0)
@@ -0,0 +1,105 @@
+import os
+import socket
+import struct
+
+# Wherever an IP address is accepted, "unix:/path/to/socket" selects a Unix
+# domain socket on the filesystem and "unix:@name" one in the Linux abstract
+# namespace. The port is then ignored.
+UNIX_PREFIX = "unix:"
+UCRED = struct.Struct("3i")  # struct ucred: pid, uid, gid
+
+
+def is_unix_address(ip) -> bool:
+    return isinstance(ip, str) and ip.startswith(UNIX_PREFIX) and ip != UNIX_PREFIX
+
+
+def unix_path(ip) -> str:
+    """Return the socket path, with a leading NUL for the abstract namespace."""
+    path = ip[len(UNIX_PREFIX) :]
+    return "\0" + path[1:] if path.startswith("@") else path
+
+
+def socket_address(ip, port):
+    """Return the address to bind or connect to for (ip, port)."""
+    return unix_path(ip) if is_unix_address(ip) else (ip, port)
+
+
+def server_socket(ip, kind=socket.SOCK_STREAM) -> socket.socket:
+    """Return an unbound server socket for the transport `ip` selects.
+
+    A stale filesystem socket left by an earlier server is removed, and
+    Unix sockets ask for the credentials of their peers (SO_PASSCRED).
+    """
+    if not is_unix_address(ip):
+        sock = socket.socket(socket.AF_INET, kind)
+        if kind == socket.SOCK_STREAM:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock
+    sock = socket.socket(socket.AF_UNIX, kind)
+    remove_unix_socket(ip)
+    if hasattr(socket, "SO_PASSCRED"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+    return sock
+
+
+def remove_unix_socket(ip) -> None:
+    """Unlink the filesystem entry of a Unix socket, abstract ones have none."""
+    if is_unix_address(ip) and not unix_path(ip).startswith("\0"):
+        try:
+            os.unlink(unix_path(ip))
+        except FileNotFoundError:
+            pass
+
+
+def client_socket(ip, kind=socket.SOCK_STREAM) -> socket.socket:
+    """Return a client socket for the transport `ip` selects."""
+    if not is_unix_address(ip):
+        return socket.socket(socket.AF_INET, kind)
+    sock = socket.socket(socket.AF_UNIX, kind)
+    if kind == socket.SOCK_DGRAM:
+        sock.bind("")  # Autobind an abstract address the server can reply to
+    return sock
+
+
+def connect_to(ip, port, timeout=None) -> socket.socket:
+    """socket.create_connection() for both TCP and Unix stream sockets."""
+    if not is_unix_address(ip):
+        return socket.create_connection((ip, port), timeout)
+    sock = client_socket(ip)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(unix_path(ip))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def peer_credentials(sock):
+    """Return (pid, uid, gid) of the process at the other end of a Unix stream."""
+    if sock.family != socket.AF_UNIX or not hasattr(socket, "SO_PEERCRED"):
+        return None
+    return UCRED.unpack(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, UCRED.size)
+    )
+
+
+def recv_credentials_into(sock, buffer):
+    """recvfrom_into() that also returns the sender's SCM_CREDENTIALS, if any.
+
+    Needs SO_PASSCRED on the socket, see server_socket(). Returns
+    (nbytes, address, (pid, uid, gid) or None).
+    """
+    n, ancdata, _, address = sock.recvmsg_into([buffer], socket.CMSG_SPACE(UCRED.size))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_CREDENTIALS:
+            return n, address, UCRED.unpack(data[: UCRED.size])
+    return n, address, None
+
+
+def describe_peer(address, credentials=None) -> str:
+    """Name a peer for logs: its address, or its pid and uid over Unix sockets."""
+    if credentials is not None:
+        pid, uid, _ = credentials
+        return f"pid {pid} (uid {uid})"
+    return str(address)
@@ -1,3 +1,5 @@
+import argparse
+
 from helpers.server import *
 
 
@@ -5,6 +7,7 @@ def main() -> None:
     default_ip = "127.0.0.1"
     default_port = 9000
     default_message = "Hello, world!"
+    default_engine = "blocking"
 
     while True:
         print("\n--- Echo Program Menu ---")
@@ -20,19 +23,24 @@ def main() -> None:
             # Input IP address and validate, use default if Enter is pressed
             while True:
                 ip = input(f"Enter IP address (default {default_ip}): ") or default_ip
-                if is_valid_ip(ip):
+                if is_valid_ip(ip) or is_unix_address(ip):
                     break
                 else:
-                    print("Invalid IP address. Please enter a valid IPv4 address.")
+                    print(
+                        "Invalid IP address. Please enter a valid IPv4 address, "
+                        "or unix:/path or unix:@name for a Unix socket."
+                    )
 
             # Input port number and validate, use default if Enter is pressed
-            while True:
+            port = default_port  # Unix sockets ignore the port
+            while not is_unix_address(ip):
                 port_input = input(f"Enter port number (default {default_port}): ")
                 if not port_input:
                     port = default_port  # use default port
                     if choice == "2" or choice == "4":
                         # Increment the port if it is already in use
-                        port = find_available_port(ip, default_port)
+                        protocol = "tcp" if choice == "2" else "udp"
+                        port = find_available_port(ip, default_port, protocol)
                     break
                 try:
                     port = int(port_input)
@@ -52,14 +60,31 @@ def main() -> None:
                     or default_message
                 )
 
+            # For servers, ask which engine to run, use default if Enter is pressed
+            if choice in ["2", "4"]:
+                engines = TCP_SERVER_ENGINES if choice == "2" else UDP_SERVER_ENGINES
+                while True:
+                    engine = (
+                        input(
+                            f"Enter server engine ({'/'.join(engines)}, default {default_engine}): "
+                        )
+                        or default_engine
+                    )
+                    if engine in engines:
+                        break
+                    else:
+                        print(
+                            "Invalid engine. Please choose one of the listed engines."
+                        )
+
             if choice == "1":
                 tcp_echo_client(ip, port, message)
             elif choice == "2":
-                tcp_echo_server(ip, port)
+                TCP_SERVER_ENGINES[engine](ip, port)
             elif choice == "3":
                 udp_echo_client(ip, port, message)
             elif choice == "4":
-                udp_echo_server(ip, port)
+                UDP_SERVER_ENGINES[engine](ip, port)
 
         elif choice == "5":
             print("Exiting...")
@@ -69,6 +94,9 @@ def main() -> None:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Interactive echo client/server menu")
+    add_metrics_arguments(parser)
+    apply_metrics_arguments(parser.parse_args())
     try:
         main()
     except KeyboardInterrupt:
@@ -2,6 +2,11 @@ import os
 import socket
 import threading
 import socketserver
+import argparse
+import time
+from collections import deque
+
+from helpers.metrics import *
 
 HOST = "localhost"
 PORT = 0
@@ -21,18 +26,152 @@ def client(ip: str, port: int, message: str) -> None:
 
 class RequestHandler(socketserver.BaseRequestHandler):
     def handle(self) -> None:
+        # Servers without MetricsMixIn are labelled by their class name
+        label = getattr(self.server, "metrics_label", type(self.server).__name__)
+        tracing = PROFILER.enabled
+        if tracing:
+            lap = time.perf_counter_ns()
         data = self.request.recv(BUFFER_SIZE)
+        if tracing:
+            lap = PROFILER.lap(label, "recv", lap)
         current_thread = threading.current_thread()
-        response = f"{current_thread.name}: {data.decode('utf-8')}"
-        self.request.sendall(response.encode("utf-8"))
+        response = f"{current_thread.name}: {data.decode('utf-8')}".encode("utf-8")
+        if tracing:
+            lap = PROFILER.lap(label, "encode", lap)
+        self.request.sendall(response)
+        if tracing:
+            PROFILER.lap(label, "send", lap)
+        METRICS.inc_many(
+            {"messages": 1, "bytes_received": len(data), "bytes_sent": len(response)},
+            server=label,
+        )
+
+
+class ThreadedServer(MetricsMixIn, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    pass
+
+
+# What to do with a new request when the accept queue is full
+OVERLOAD_POLICIES = ("reject", "wait", "shed_oldest")
+
+
+class ThreadPoolMixIn:
+    """Mix-in class to handle each request on a fixed pool of worker threads.
 
+    Accepted requests wait in a queue of at most `queue_size` entries. When
+    it is full, `overload_policy` either closes the new connection ("reject"),
+    blocks the accept loop until a worker frees a slot ("wait"), or closes
+    the longest waiting connection to make room ("shed_oldest").
+    """
 
-class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    pool_size = 8
+    queue_size = 64
+    overload_policy = "wait"
+
+    def server_activate(self) -> None:
+        super().server_activate()
+        if self.overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy: {self.overload_policy}")
+        self._queue = deque()  # (request, client_address, time queued)
+        self._cond = threading.Condition()
+        self._closing = False
+        self._counters = {"handled": 0, "rejected": 0, "shed": 0, "max_depth": 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._workers = [
+            threading.Thread(target=self._work, name=f"pool-{i}", daemon=True)
+            for i in range(self.pool_size)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def process_request(self, request, client_address) -> None:
+        """Queue the request for the pool, applying the overload policy."""
+        with self._cond:
+            if len(self._queue) >= self.queue_size:
+                if self.overload_policy == "reject":
+                    self._counters["rejected"] += 1
+                    self.shutdown_request(request)
+                    return
+                elif self.overload_policy == "shed_oldest":
+                    self._counters["shed"] += 1
+                    self.shutdown_request(self._queue.popleft()[0])
+                else:
+                    while len(self._queue) >= self.queue_size and not self._closing:
+                        self._cond.wait()
+            self._queue.append((request, client_address, time.monotonic()))
+            depth = len(self._queue)
+            self._counters["max_depth"] = max(self._counters["max_depth"], depth)
+            self._cond.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                request, client_address, queued = self._queue.popleft()
+                waited = time.monotonic() - queued
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._counters["handled"] += 1
+                self._cond.notify_all()  # A slot is free for a waiting accept
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def stats(self) -> dict:
+        """Return queue depth, overload counters and queue wait times."""
+        with self._cond:
+            handled = self._counters["handled"]
+            return {
+                "queue_depth": len(self._queue),
+                **self._counters,
+                "wait_avg_ms": round(self._wait_total / max(handled, 1) * 1000, 3),
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+    def server_close(self) -> None:
+        super().server_close()
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+
+class ThreadPoolServer(MetricsMixIn, ThreadPoolMixIn, socketserver.TCPServer):
     pass
 
 
 if __name__ == "__main__":
-    server = ThreadedServer((HOST, PORT), RequestHandler)
+    parser = argparse.ArgumentParser(description="Threaded echo server example")
+    parser.add_argument(
+        "--pool",
+        type=int,
+        default=0,
+        help="Handle requests on this many pooled threads instead of one per request.",
+    )
+    parser.add_argument(
+        "--overload-policy",
+        choices=OVERLOAD_POLICIES,
+        default="wait",
+        help="What to do when the pool's accept queue is full.",
+    )
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    apply_metrics_arguments(args)
+
+    if args.pool:
+        ThreadPoolServer.pool_size = args.pool
+        ThreadPoolServer.overload_policy = args.overload_policy
+        server = ThreadPoolServer((HOST, PORT), RequestHandler)
+    else:
+        server = ThreadedServer((HOST, PORT), RequestHandler)
     ip, port = server.server_address
 
     server_thread = threading.Thread(target=server.serve_forever)
@@ -45,3 +184,7 @@ if __name__ == "__main__":
     client(ip, port, "Hello from client 3")
 
     server.shutdown()
+    if args.pool:
+        print(f"Pool stats: {server.stats()}")
+    print(METRICS.to_json())
+    server.server_close()
@@ -1,42 +1,39 @@
+import argparse
 import tkinter as tk
 from tkinter import messagebox, font
 from helpers.server import *
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
 
-stop_event = Event()
+# Starts every server with its own StopEvent and stops them all without delay
+servers = ServerController()
+# Clients run on a few reused threads instead of a new thread per click
+client_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="client")
 
 
-# Function to run the TCP Echo client in a separate thread
+# Function to run the TCP Echo client on the client thread pool
 def start_tcp_client(ip, port, message):
-    Thread(target=tcp_echo_client, args=(ip, port, message)).start()
+    client_executor.submit(tcp_echo_client, ip, port, message)
 
 
 # Function to run the TCP Echo server in a separate thread
-def start_tcp_server(ip, port):
-    global tcp_thread
-    tcp_thread = Thread(target=tcp_echo_server, args=(ip, port, stop_event))
-    tcp_thread.start()
+def start_tcp_server(ip, port, engine="blocking"):
+    servers.start(f"tcp-{ip}:{port}", TCP_SERVER_ENGINES[engine], ip, port)
 
 
-# Function to run the UDP Echo client in a separate thread
+# Function to run the UDP Echo client on the client thread pool
 def start_udp_client(ip, port, message):
-    Thread(target=udp_echo_client, args=(ip, port, message)).start()
+    client_executor.submit(udp_echo_client, ip, port, message)
 
 
 # Function to run the UDP Echo server in a separate thread
-def start_udp_server(ip, port):
-    global udp_thread
-    udp_thread = Thread(target=udp_echo_server, args=(ip, port, stop_event))
-    udp_thread.start()
+def start_udp_server(ip, port, engine="blocking"):
+    servers.start(f"udp-{ip}:{port}", UDP_SERVER_ENGINES[engine], ip, port)
 
 
 def on_exit():
     print("Stopping servers...")
-    stop_event.set()  # Signal servers to stop
-    if "tcp_thread" in globals() and tcp_thread.is_alive():
-        tcp_thread.join()  # Wait for TCP server to stop
-    if "udp_thread" in globals() and udp_thread.is_alive():
-        udp_thread.join()  # Wait for UDP server to stop
+    client_executor.shutdown(wait=False, cancel_futures=True)
+    servers.stop()  # Wakes every server at once and waits for them to exit
     print("Servers stopped.")
     root.quit()
 
@@ -46,7 +43,7 @@ class EchoApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Echo Server/Client")
-        self.root.geometry("500x400")
+        self.root.geometry("500x480")
         self.root.configure(bg="#f0f0f0")  # Light gray background
 
         # Custom Font
@@ -93,6 +90,22 @@ class EchoApp:
         self.message_entry.insert(0, self.default_message)
         self.message_entry.grid(row=2, column=1, padx=10, pady=5)
 
+        tk.Label(
+            self.frame, text="TCP Server Engine:", font=self.default_font, bg="#f0f0f0"
+        ).grid(row=3, column=0, padx=10, pady=5, sticky="w")
+        self.engine_var = tk.StringVar(value="blocking")
+        tk.OptionMenu(self.frame, self.engine_var, *TCP_SERVER_ENGINES).grid(
+            row=3, column=1, padx=10, pady=5, sticky="ew"
+        )
+
+        tk.Label(
+            self.frame, text="UDP Server Engine:", font=self.default_font, bg="#f0f0f0"
+        ).grid(row=4, column=0, padx=10, pady=5, sticky="w")
+        self.udp_engine_var = tk.StringVar(value="blocking")
+        tk.OptionMenu(self.frame, self.udp_engine_var, *UDP_SERVER_ENGINES).grid(
+            row=4, column=1, padx=10, pady=5, sticky="ew"
+        )
+
         # Buttons for starting clients/servers with modern styling
         button_style = {
             "bg": "#0078d4",
@@ -106,32 +119,32 @@ class EchoApp:
             text="Start TCP Echo Client",
             command=self.run_tcp_client,
             **button_style,
-        ).grid(row=3, column=0, padx=10, pady=5, sticky="ew")
+        ).grid(row=5, column=0, padx=10, pady=5, sticky="ew")
 
         tk.Button(
             self.frame,
             text="Start TCP Echo Server",
             command=self.run_tcp_server,
             **button_style,
-        ).grid(row=3, column=1, padx=10, pady=5, sticky="ew")
+        ).grid(row=5, column=1, padx=10, pady=5, sticky="ew")
 
         tk.Button(
             self.frame,
             text="Start UDP Echo Client",
             command=self.run_udp_client,
             **button_style,
-        ).grid(row=4, column=0, padx=10, pady=5, sticky="ew")
+        ).grid(row=6, column=0, padx=10, pady=5, sticky="ew")
 
         tk.Button(
             self.frame,
             text="Start UDP Echo Server",
             command=self.run_udp_server,
             **button_style,
-        ).grid(row=4, column=1, padx=10, pady=5, sticky="ew")
+        ).grid(row=6, column=1, padx=10, pady=5, sticky="ew")
 
         # Exit Button
         tk.Button(self.frame, text="Exit", command=on_exit, **button_style).grid(
-            row=5, column=0, columnspan=2, pady=10, sticky="ew"
+            row=7, column=0, columnspan=2, pady=10, sticky="ew"
         )
 
     def get_ip_and_port(self, type=None):
@@ -139,6 +152,8 @@ class EchoApp:
         ip = self.ip_entry.get()
         port = self.port_entry.get()
 
+        if is_unix_address(ip):
+            return ip, 0  # unix:/path or unix:@name, the port is ignored
         if not is_valid_ip(ip):
             messagebox.showerror("Invalid Input", "Please enter a valid IP address.")
             return None, None
@@ -148,6 +163,8 @@ class EchoApp:
                 raise ValueError
             if type is None:
                 return ip, port
+            # Skip ports already in use, the server releases the reservation
+            port = find_available_port(ip, port, type)
             self.port_entry.delete(0, tk.END)
             self.port_entry.insert(0, str(port + 1))
             return ip, port
@@ -160,32 +177,35 @@ class EchoApp:
     def run_tcp_client(self):
         """Start the TCP Echo Client."""
         ip, port = self.get_ip_and_port()
-        if ip and port:
+        if ip:
             message = self.message_entry.get() or self.default_message
             start_tcp_client(ip, port, message)
 
     def run_tcp_server(self):
         """Start the TCP Echo Server."""
         ip, port = self.get_ip_and_port("tcp")
-        if ip and port:
-            start_tcp_server(ip, port)
+        if ip:
+            start_tcp_server(ip, port, self.engine_var.get())
 
     def run_udp_client(self):
         """Start the UDP Echo Client."""
         ip, port = self.get_ip_and_port()
-        if ip and port:
+        if ip:
             message = self.message_entry.get() or self.default_message
             start_udp_client(ip, port, message)
 
     def run_udp_server(self):
         """Start the UDP Echo Server."""
         ip, port = self.get_ip_and_port("udp")
-        if ip and port:
-            start_udp_server(ip, port)
+        if ip:
+            start_udp_server(ip, port, self.udp_engine_var.get())
 
 
 # Run the Tkinter application
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Echo server/client GUI")
+    add_metrics_arguments(parser)
+    apply_metrics_arguments(parser.parse_args())
     root = tk.Tk()
     root.protocol("WM_DELETE_WINDOW", on_exit)
     app = EchoApp(root)